@@ -60,7 +60,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
         await self.send(text_data=json.dumps({
             'role': event['role'],
             'message': event['message'],
-            'image': event.get('image')
+            'image': event.get('image'),
+            'analysis_id': event.get('analysis_id'),
+            'status': event.get('status'),
         }))
 
     @sync_to_async
@@ -74,7 +76,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         ChatMessage.objects.create(session=session, role='user', content=message)
 
-        metrics = session.analysis.metrics if session.analysis else {}
+        metrics = (session.analysis.metrics or {}) if session.analysis else {}
         prompt = (
             f"Ты — профессиональный агроном FloraAI. Данные растения: "
             f"Культура: {metrics.get('plant_type', 'Неизвестно')}, "
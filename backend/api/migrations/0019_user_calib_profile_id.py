@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_add_model_name_to_annotation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='calib_profile_id',
+            field=models.CharField(blank=True, default='', max_length=32, verbose_name='ID профиля калибровки в ML'),
+        ),
+    ]
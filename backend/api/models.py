@@ -25,6 +25,7 @@ class User(AbstractUser):
     calib_mm_per_pixel = models.FloatField(null=True, blank=True, verbose_name="мм/пиксель")
     calib_cm2_per_pixel = models.FloatField(null=True, blank=True, verbose_name="см²/пиксель")
     calib_reprojection_error = models.FloatField(null=True, blank=True, verbose_name="Ошибка репроекции")
+    calib_profile_id = models.CharField(max_length=32, blank=True, default='', verbose_name="ID профиля калибровки в ML")
 
     def __str__(self):
         return self.username
@@ -0,0 +1,68 @@
+import base64
+
+
+# Компактная геометрия разметки (тот же формат, что отдаёт ML-сервис при geometry_format=compact):
+# вместо "path": [[x, y], ...] хранится "path_enc" — base64 от zigzag-varint последовательности
+# x0, y0, dx1, dy1, ... (первая точка абсолютная, дальше смещения от предыдущей).
+
+def encode_path(points):
+    out = bytearray()
+    prev_x = prev_y = 0
+    for x, y in points:
+        for delta in (int(x) - prev_x, int(y) - prev_y):
+            value = (delta << 1) ^ (delta >> 63)
+            while value >= 0x80:
+                out.append((value & 0x7F) | 0x80)
+                value >>= 7
+            out.append(value)
+        prev_x, prev_y = int(x), int(y)
+    return base64.b64encode(bytes(out)).decode('ascii')
+
+
+def decode_path(encoded):
+    data = base64.b64decode(encoded)
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append((value >> 1) ^ -(value & 1))
+        value = shift = 0
+
+    points = []
+    x = y = 0
+    for i in range(0, len(values) - 1, 2):
+        x += values[i]
+        y += values[i + 1]
+        points.append([x, y])
+    return points
+
+
+def compact_items(items):
+    """path → path_enc (элементы, уже закодированные ML-сервисом, не трогаются)."""
+    result = []
+    for item in items or []:
+        if 'path' in item:
+            compact = {k: v for k, v in item.items() if k != 'path'}
+            compact['path_enc'] = encode_path(item['path'])
+            item = compact
+        result.append(item)
+    return result
+
+
+def expand_items(items):
+    """path_enc → path для клиентов, которые ждут JSON-массивы точек."""
+    result = []
+    for item in items or []:
+        if 'path_enc' in item:
+            expanded = {k: v for k, v in item.items() if k != 'path_enc'}
+            expanded['path'] = decode_path(item['path_enc'])
+            item = expanded
+        result.append(item)
+    return result
+
+
+def format_items(items, geometry_format):
+    return compact_items(items) if geometry_format == 'compact' else expand_items(items)
@@ -2,16 +2,59 @@ import json
 import requests
 import base64
 import os
-from django.core.files.base import ContentFile
+import tempfile
+from django.core.files.base import ContentFile, File
+
+# Запрос выполняется в Celery-воркере, а не в потоке HTTP — DeepScan может идти долго
+ML_PREDICT_TIMEOUT = int(os.getenv('ML_PREDICT_TIMEOUT', 120))
+# Геометрия разметки запрашивается в компактном виде (path_enc), допуск упрощения контуров в пикселях
+ML_GEOMETRY_SIMPLIFY_PX = float(os.getenv('ML_GEOMETRY_SIMPLIFY_PX', 0))
+
+
+# Части multipart-ответа пишутся на диск кусками такого размера
+ML_STREAM_CHUNK = 64 * 1024
+
+
+class MLServiceBusy(Exception):
+    """ML-сервис ответил 429 (очередь инференса заполнена)."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"ML-сервис перегружен, повтор через {retry_after} с")
+        self.retry_after = retry_after
+
+
+def register_calibration_profile(user):
+    """Регистрирует калибровку пользователя профилем в ML-сервисе и сохраняет calibration_id.
+    Нужно для калибровок, сделанных до появления профилей, и если ML-сервис потерял профиль."""
+    try:
+        response = requests.post("http://flora_ml:8001/calibration/profiles", data={
+            'camera_matrix_json': json.dumps(user.calib_camera_matrix),
+            'dist_coeffs_json': json.dumps(user.calib_dist_coeffs),
+        }, timeout=10)
+        if response.status_code == 200:
+            user.calib_profile_id = response.json()['calibration_id']
+            user.save(update_fields=['calib_profile_id'])
+            return user.calib_profile_id
+        print(f"ML Calibration Profile Error: HTTP {response.status_code}")
+    except Exception as e:
+        print(f"ML Calibration Profile Error: {e}")
+    return None
 
 
 def _calib_payload(user):
-    """Формирует dict с параметрами калибровки пользователя (если есть)."""
+    """Формирует dict с параметрами калибровки пользователя (если есть).
+    Матрицы передаются ссылкой на профиль (calibration_id); JSON — только если профиль
+    зарегистрировать не удалось."""
     payload = {}
-    if user and getattr(user, 'calib_camera_matrix', None):
-        payload['camera_matrix_json'] = json.dumps(user.calib_camera_matrix)
-    if user and getattr(user, 'calib_dist_coeffs', None):
-        payload['dist_coeffs_json'] = json.dumps(user.calib_dist_coeffs)
+    has_matrices = user and getattr(user, 'calib_camera_matrix', None) and getattr(user, 'calib_dist_coeffs', None)
+    profile_id = has_matrices and (getattr(user, 'calib_profile_id', '') or register_calibration_profile(user))
+    if profile_id:
+        payload['calibration_id'] = profile_id
+    else:
+        if user and getattr(user, 'calib_camera_matrix', None):
+            payload['camera_matrix_json'] = json.dumps(user.calib_camera_matrix)
+        if user and getattr(user, 'calib_dist_coeffs', None):
+            payload['dist_coeffs_json'] = json.dumps(user.calib_dist_coeffs)
     if user and getattr(user, 'calib_mm_per_pixel', None):
         payload['user_mm_per_pixel'] = user.calib_mm_per_pixel
     if user and getattr(user, 'calib_cm2_per_pixel', None):
@@ -19,6 +62,74 @@ def _calib_payload(user):
     return payload
 
 
+def _post_ml(path, files, data, user, timeout, stream=False):
+    """POST в ML-сервис. Если ML-сервис не знает calibration_id (409 — профиль потерян вместе
+    с контейнером), профиль регистрируется заново и запрос повторяется один раз."""
+    url = f"http://flora_ml:8001{path}"
+    response = requests.post(url, files=files, data=data, timeout=timeout, stream=stream)
+    if response.status_code == 409 and 'calibration_id' in data and user is not None:
+        response.close()
+        user.calib_profile_id = ''
+        data = {k: v for k, v in data.items() if k != 'calibration_id'}
+        data.update(_calib_payload(user))
+        response = requests.post(url, files=files, data=data, timeout=timeout, stream=stream)
+    return response
+
+
+def _read_multipart(response):
+    """Потоковый разбор ответа ML-сервиса с response_format=multipart (у каждой части есть
+    Content-Length). Возвращает (metrics dict, JPEG во временном файле | None) — изображение
+    пишется на диск кусками и целиком в памяти не держится."""
+    boundary = response.headers['Content-Type'].split('boundary=', 1)[1].encode()
+    raw = response.raw
+    raw.decode_content = True
+    metrics, image = None, None
+
+    while True:
+        line = raw.readline()
+        if not line or line.strip() == b'--' + boundary + b'--':
+            break
+        if line.strip() != b'--' + boundary:
+            continue
+
+        headers = {}
+        while True:
+            header = raw.readline().strip()
+            if not header:
+                break
+            name, _, value = header.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        remaining = int(headers['content-length'])
+        if headers.get('content-type', '').startswith('application/json'):
+            metrics = json.loads(raw.read(remaining))
+            continue
+
+        image = tempfile.TemporaryFile()
+        while remaining:
+            chunk = raw.read(min(remaining, ML_STREAM_CHUNK))
+            if not chunk:
+                raise IOError("Обрыв multipart-ответа ML-сервиса")
+            image.write(chunk)
+            remaining -= len(chunk)
+        image.seek(0)
+
+    return metrics, image
+
+
+def _annotated_result(response, filename):
+    """(metrics, файл изображения | None) из ответа /annotate или /render: multipart или
+    прежний JSON с annotated_image_base64 (ML-сервис старой версии)."""
+    name = f"annotated_{filename}"
+    if response.headers.get('Content-Type', '').startswith('multipart/'):
+        metrics, image = _read_multipart(response)
+        return metrics or {}, File(image, name=name) if image is not None else None
+
+    resp_json = response.json()
+    img_b64 = resp_json.pop('annotated_image_base64', None)
+    return resp_json, ContentFile(base64.b64decode(img_b64), name=name) if img_b64 else None
+
+
 def get_available_models():
     try:
         response = requests.get("http://flora_ml:8001/models", timeout=10)
@@ -30,31 +141,41 @@ def get_available_models():
 
 
 def analyze_plant_image(image_file, conf, iou, imgsz, user=None, model_name=None):
-    files = {'file': (image_file.name, image_file.read(), image_file.content_type)}
+    """Синхронный вызов ML /predict. Возвращает (metrics, annotated ContentFile | None);
+    metrics = None, если ML-сервис недоступен или ответил ошибкой.
+    При переполненной очереди ML-сервиса (429) бросает MLServiceBusy."""
+    filename = os.path.basename(image_file.name)
+    content_type = getattr(image_file, 'content_type', None) or 'image/jpeg'
+    files = {'file': (filename, image_file.read(), content_type)}
     data_payload = {'conf': conf, 'iou': iou, 'imgsz': imgsz}
     if model_name:
         data_payload['model_name'] = model_name
     data_payload.update(_calib_payload(user))
 
-    ml_data = {
-        "plant_type": "Неизвестно",
-        "leaf_area_cm2": 0,
-        "root_length_mm": 0,
-        "stem_length_mm": 0
-    }
+    ml_data = None
     annotated_image_content = None
 
     try:
-        response = requests.post("http://flora_ml:8001/predict", files=files, data=data_payload, timeout=40)
+        response = _post_ml("/predict", files, data_payload, user, ML_PREDICT_TIMEOUT)
+    except Exception as e:
+        print(f"ML Error: {e}")
+        return ml_data, annotated_image_content
+
+    if response.status_code == 429:
+        raise MLServiceBusy(int(response.headers.get('Retry-After', 5)))
+
+    try:
         if response.status_code == 200:
             response_json = response.json()
             img_b64 = response_json.pop('annotated_image_base64', None)
 
             if img_b64:
                 image_data = base64.b64decode(img_b64)
-                annotated_image_content = ContentFile(image_data, name=f"annotated_{image_file.name}")
+                annotated_image_content = ContentFile(image_data, name=f"annotated_{filename}")
 
             ml_data = response_json
+        else:
+            print(f"ML Error: HTTP {response.status_code}")
     except Exception as e:
         print(f"ML Error: {e}")
 
@@ -72,16 +193,18 @@ def get_annotated_image(image_file, conf, iou, imgsz, color_leaf="#16A34A", colo
             'color_leaf': color_leaf, 'color_root': color_root, 'color_stem': color_stem,
             'deep_scan': 'true' if deep_scan else 'false',
             'bake_overlay': 'true' if bake_overlay else 'false',
+            'geometry_format': 'compact',
+            'simplify_px': ML_GEOMETRY_SIMPLIFY_PX,
+            'response_format': 'multipart',
         }
         if model_name:
             data_payload['model_name'] = model_name
         data_payload.update(_calib_payload(user))
 
-        response = requests.post("http://flora_ml:8001/annotate", files=files, data=data_payload, timeout=120)
+        response = _post_ml("/annotate", files, data_payload, user, 120, stream=True)
 
         if response.status_code == 200:
-            resp_json = response.json()
-            img_b64 = resp_json.get('annotated_image_base64')
+            resp_json, annotated_file = _annotated_result(response, filename)
             segments = resp_json.get('segments', [])
             leaves = resp_json.get('leaves', [])
             stems = resp_json.get('stems', [])
@@ -89,16 +212,42 @@ def get_annotated_image(image_file, conf, iou, imgsz, color_leaf="#16A34A", colo
                 'leaf_area_cm2': resp_json.get('leaf_area_cm2', 0.0),
                 'stem_length_mm': resp_json.get('stem_length_mm', 0.0),
                 'is_baked': resp_json.get('is_baked', False),
+                'cache_hit': resp_json.get('cache_hit', False),
             }
-            if img_b64:
-                image_data = base64.b64decode(img_b64)
-                return ContentFile(image_data, name=f"annotated_{filename}"), segments, leaves, stems, extra_metrics
+            if annotated_file:
+                return annotated_file, segments, leaves, stems, extra_metrics
     except Exception as e:
         print(f"ML Annotate Error: {e}")
 
     return None, [], [], [], {}
 
 
+def render_annotated_image(image_file, conf, iou, imgsz, color_leaf="#16A34A", color_root="#9333EA", color_stem="#2563EB", deep_scan=False, bake_overlay=False, user=None, model_name=None):
+    """Перекраска overlay по маскам, уже посчитанным ML-сервисом для тех же параметров анализа.
+    Возвращает файл изображения или None (масок нет / ошибка) — тогда нужен полный get_annotated_image."""
+    try:
+        filename = os.path.basename(image_file.name)
+        files = {'file': (filename, image_file.read(), 'image/jpeg')}
+        data_payload = {
+            'conf': conf, 'iou': iou, 'imgsz': imgsz,
+            'color_leaf': color_leaf, 'color_root': color_root, 'color_stem': color_stem,
+            'deep_scan': 'true' if deep_scan else 'false',
+            'bake_overlay': 'true' if bake_overlay else 'false',
+            'response_format': 'multipart',
+        }
+        if model_name:
+            data_payload['model_name'] = model_name
+        data_payload.update(_calib_payload(user))
+
+        response = _post_ml("/render", files, data_payload, user, 30, stream=True)
+        if response.status_code == 200:
+            return _annotated_result(response, filename)[1]
+    except Exception as e:
+        print(f"ML Render Error: {e}")
+
+    return None
+
+
 def calibrate_camera(images, rows, cols, square_size_mm):
     """Отправляет фото шахматной доски в ML-сервис для калибровки камеры."""
     files = [('files', (img.name, img.read(), img.content_type)) for img in images]
@@ -0,0 +1,100 @@
+import os
+import requests
+from celery import shared_task
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+
+from .models import PlantAnalysis, ChatMessage
+from .services.ml_client import analyze_plant_image, MLServiceBusy
+
+
+def _build_bot_reply(metrics):
+    return (
+        f"✅ Анализ завершен!\n\n"
+        f"🌿 Культура: {metrics.get('plant_type', 'Неизвестно')}\n"
+        f"📏 Площадь листьев: {metrics.get('leaf_area_cm2', 0)} см²\n"
+        f"📏 Длина корня: {metrics.get('root_length_mm', 0)} мм\n"
+        f"📏 Длина стебля: {metrics.get('stem_length_mm', 0)} мм"
+    )
+
+
+FAILED_REPLY = "❌ Не удалось проанализировать фото. Попробуйте отправить его ещё раз позже."
+
+
+def _save_result(analysis, ml_data):
+    """COMPLETED с метриками или FAILED; возвращает ответ ассистента для чата."""
+    if ml_data is not None:
+        try:
+            bot_reply = _build_bot_reply(ml_data)
+            analysis.status = 'COMPLETED'
+            analysis.metrics = ml_data
+            analysis.save(update_fields=['status', 'metrics'])
+            return bot_reply
+        except Exception as e:
+            print(f"Analysis Save Error: {e}")
+    analysis.status = 'FAILED'
+    analysis.save(update_fields=['status'])
+    return FAILED_REPLY
+
+
+def _notify_chat(analysis, bot_reply):
+    session = getattr(analysis, 'chat', None)
+    if session is None:
+        return
+    try:
+        ChatMessage.objects.create(session=session, role='assistant', content=bot_reply)
+
+        channel_layer = get_channel_layer()
+        async_to_sync(channel_layer.group_send)(
+            f'chat_{session.id}',
+            {
+                'type': 'chat_message', 'role': 'assistant', 'message': bot_reply, 'image': None,
+                'analysis_id': analysis.id, 'status': analysis.status,
+            }
+        )
+    except Exception as e:
+        print(f"Chat Notify Error: {e}")
+
+
+def _notify_telegram(user, bot_reply):
+    bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not bot_token:
+        return
+    try:
+        response = requests.post(f"https://api.telegram.org/bot{bot_token}/sendMessage",
+                                 json={"chat_id": user.telegram_id, "text": bot_reply}, timeout=5)
+        if not response.ok:
+            print(f"Telegram Notify Error: HTTP {response.status_code}")
+    except Exception as e:
+        print(f"Telegram Notify Error: {e}")
+
+
+@shared_task(bind=True, max_retries=20)
+def run_plant_analysis(self, analysis_id, notify_telegram=False):
+    """Воркер очереди анализов: PENDING → вызов ML /predict → COMPLETED/FAILED.
+    Ответ ассистента сохраняется в чат и рассылается в группу Channels `chat_<session_id>`.
+    Любая ошибка, кроме переполненной очереди ML, завершает анализ как FAILED, а не оставляет PENDING."""
+    analysis = PlantAnalysis.objects.select_related('user').filter(id=analysis_id).first()
+    if analysis is None or analysis.status != 'PENDING':
+        return
+
+    # Значения по умолчанию — в полях модели User
+    user = analysis.user
+    try:
+        with analysis.original_image.open('rb') as image:
+            ml_data, _ = analyze_plant_image(image, user.yolo_conf, user.yolo_iou, user.yolo_imgsz, user=user)
+    except MLServiceBusy as e:
+        # Очередь ML-сервиса заполнена — анализ остаётся PENDING и повторяется позже
+        if self.request.retries < self.max_retries:
+            raise self.retry(countdown=e.retry_after)
+        ml_data = None
+    except Exception as e:
+        print(f"Analysis Task Error: {e}")
+        ml_data = None
+
+    bot_reply = _save_result(analysis, ml_data)
+    _notify_chat(analysis, bot_reply)
+
+    # Фото пришло из Telegram — результат отправляем туда же
+    if notify_telegram and user.telegram_id:
+        _notify_telegram(user, bot_reply)
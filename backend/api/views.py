@@ -3,14 +3,22 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from django.contrib.auth import get_user_model
 from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.db.models import Prefetch
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition
 from .models import PlantAnalysis, ChatMessage, ChatSession, MessageAnnotation, SiteSettings
 from .serializers import PlantAnalysisSerializer, UserSerializer, RegisterSerializer
 import os
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
-from .services.ml_client import analyze_plant_image, get_annotated_image, calibrate_camera, get_available_models
+from .services.ml_client import get_annotated_image, render_annotated_image, calibrate_camera, get_available_models
 from .services.yandex_gpt_client import get_agronomist_reply
+from .services.geometry import format_items
+from .tasks import run_plant_analysis
 
 User = get_user_model()
 
@@ -148,20 +156,11 @@ class PlantAnalysisViewSet(viewsets.ModelViewSet):
             if PlantAnalysis.objects.filter(user=user).count() >= 3:
                 return Response({"error": "limit_reached"}, status=403)
 
-        user_conf = user.yolo_conf if hasattr(user, 'yolo_conf') else 0.25
-        user_iou = user.yolo_iou if hasattr(user, 'yolo_iou') else 0.7
-        user_imgsz = user.yolo_imgsz if hasattr(user, 'yolo_imgsz') else 1024
-
-        # --- ИСПОЛЬЗУЕМ ВЫНЕСЕННЫЙ СЕРВИС ML ---
-        image.seek(0)
-        ml_data, _ = analyze_plant_image(image, user_conf, user_iou, user_imgsz, user=user)
-        image.seek(0)
-
+        # --- СТАВИМ АНАЛИЗ В ОЧЕРЕДЬ (ML вызывается в Celery-воркере, см. api/tasks.py) ---
         analysis = PlantAnalysis.objects.create(
             user=user,
             original_image=image,
-            status='COMPLETED',
-            metrics=ml_data
+            status='PENDING',
         )
 
         session = ChatSession.objects.create(user=user, analysis=analysis)
@@ -170,22 +169,17 @@ class PlantAnalysisViewSet(viewsets.ModelViewSet):
         ChatMessage.objects.create(session=session, role='user', image=analysis.original_image,
                                    content="Отправил(а) фото на анализ")
 
-        bot_reply = (
-            f"✅ Анализ завершен!\n\n"
-            f"🌿 Культура: {analysis.metrics.get('plant_type', 'Неизвестно')}\n"
-            f"📏 Площадь листьев: {analysis.metrics.get('leaf_area_cm2', 0)} см²\n"
-            f"📏 Длина корня: {analysis.metrics.get('root_length_mm', 0)} мм\n"
-            f"📏 Длина стебля: {analysis.metrics.get('stem_length_mm', 0)} мм"
-        )
-
-        ChatMessage.objects.create(session=session, role='assistant', content=bot_reply)
+        notify_telegram = bool(telegram_id)
+        transaction.on_commit(lambda: run_plant_analysis.delay(analysis.id, notify_telegram))
 
+        # Результат придёт ответом ассистента через WebSocket-группу chat_<session_id>
+        # (и сообщением в Telegram, если фото прислал бот)
         response_data = self.get_serializer(analysis).data
         response_data['session_id'] = session.id
-        response_data['bot_reply'] = bot_reply
+        response_data['bot_reply'] = "⏳ Фото принято, анализ в очереди. Результат придёт отдельным сообщением."
         response_data['is_linked'] = is_linked
 
-        return Response(response_data, status=201)
+        return Response(response_data, status=status.HTTP_202_ACCEPTED)
 
 # --- 3. ЧАТ С АГРОНОМОМ YANDEX GPT ---
 class ChatAPIView(APIView):
@@ -198,7 +192,7 @@ class ChatAPIView(APIView):
         return Response([
             {
                 "id": s.id,
-                "title": f"{s.analysis.metrics.get('plant_type', 'Растение')} (Анализ #{s.analysis.id})" if s.analysis else "Новый чат",
+                "title": f"{(s.analysis.metrics or {}).get('plant_type', 'Растение')} (Анализ #{s.analysis.id})" if s.analysis else "Новый чат",
                 "created_at": s.created_at
             } for s in sessions
         ])
@@ -235,7 +229,7 @@ class ChatAPIView(APIView):
         )
 
         # --- 3. ОБЩЕНИЕ С ИИ ---
-        metrics = session.analysis.metrics if session.analysis else {}
+        metrics = (session.analysis.metrics or {}) if session.analysis else {}
         prompt = f"Ты — агроном FloraAI. Данные: {metrics.get('plant_type', 'Неизвестно')}..."
         past = list(reversed(ChatMessage.objects.filter(session=session).order_by('-created_at')[:10]))
         bot_reply_text = get_agronomist_reply(prompt, past, message)
@@ -263,13 +257,49 @@ class ChatAPIView(APIView):
 
         return Response({"reply": bot_reply_text, "session_id": session.id})
 # --- 4. ИСТОРИЯ КОНКРЕТНОГО ЧАТА ---
+def _annotation_meta(request, a):
+    return {
+        "id": a.id,
+        "image": request.build_absolute_uri(a.image.url) if a.image else None,
+        "conf": a.conf,
+        "iou": a.iou,
+        "imgsz": a.imgsz,
+        "leaf_area_cm2": a.leaf_area_cm2,
+        "stem_length_mm": a.stem_length_mm,
+        "is_deep_scan": a.is_deep_scan,
+        "is_baked": a.is_baked,
+        "model_name": a.model_name,
+    }
+
+
 class ChatDetailAPIView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, session_id):
         session = get_object_or_404(ChatSession, id=session_id, user=request.user)
+        # ?geometry=compact — контуры в виде path_enc; по умолчанию JSON-массивы точек для старых клиентов
+        geometry_format = request.query_params.get('geometry', 'json')
+        # ?annotations=slim — только метаданные разметок и geometry_url, контуры грузятся по требованию
+        slim = request.query_params.get('annotations') == 'slim'
+
+        annotations_qs = MessageAnnotation.objects.all()
+        if slim:
+            annotations_qs = annotations_qs.defer('segments', 'leaves', 'stems')
         # prefetch_related ускорит загрузку истории разметок
-        messages = session.messages.prefetch_related('annotations').all().order_by('created_at')
+        messages = session.messages.prefetch_related(
+            Prefetch('annotations', queryset=annotations_qs)
+        ).all().order_by('created_at')
+
+        def annotation_payload(a):
+            payload = _annotation_meta(request, a)
+            if slim:
+                payload["geometry_url"] = request.build_absolute_uri(
+                    reverse('annotation-geometry', args=[a.id]))
+            else:
+                payload["segments"] = format_items(a.segments, geometry_format)
+                payload["leaves"] = format_items(a.leaves, geometry_format)
+                payload["stems"] = format_items(a.stems, geometry_format)
+            return payload
 
         return Response([
             {
@@ -278,26 +308,40 @@ class ChatDetailAPIView(APIView):
                 "content": m.content,
                 "image": request.build_absolute_uri(m.image.url) if m.image else None,
                 # Добавляем список всех сгенерированных разметок для этого фото
-                "annotations": [
-                    {
-                        "id": a.id,
-                        "image": request.build_absolute_uri(a.image.url) if a.image else None,
-                        "conf": a.conf,
-                        "iou": a.iou,
-                        "imgsz": a.imgsz,
-                        "segments": a.segments,
-                        "leaves": a.leaves,
-                        "stems": a.stems,
-                        "leaf_area_cm2": a.leaf_area_cm2,
-                        "stem_length_mm": a.stem_length_mm,
-                        "is_deep_scan": a.is_deep_scan,
-                        "is_baked": a.is_baked,
-                        "model_name": a.model_name,
-                    } for a in m.annotations.all()
-                ]
+                "annotations": [annotation_payload(a) for a in m.annotations.all()]
             } for m in messages
         ])
 
+
+def _annotation_geometry_etag(request, annotation_id):
+    """Разметка после создания не меняется — ETag из id, времени создания и формата геометрии.
+    None (чужая / несуществующая разметка) — условный запрос не обрабатывается, view вернёт 404."""
+    created_at = MessageAnnotation.objects.filter(
+        id=annotation_id, message__session__user=request.user,
+    ).values_list('created_at', flat=True).first()
+    if created_at is None:
+        return None
+    return f"ann-{annotation_id}-{int(created_at.timestamp() * 1000)}-{request.GET.get('geometry', 'json')}"
+
+
+@method_decorator(gzip_page, name='dispatch')
+class AnnotationGeometryView(APIView):
+    """Контуры одной разметки (segments/leaves/stems). Поддерживает If-None-Match → 304 и gzip."""
+    permission_classes = [permissions.IsAuthenticated]
+
+    @method_decorator(condition(etag_func=_annotation_geometry_etag))
+    def get(self, request, annotation_id):
+        annotation = get_object_or_404(MessageAnnotation, id=annotation_id, message__session__user=request.user)
+        geometry_format = request.query_params.get('geometry', 'json')
+        response = Response({
+            "id": annotation.id,
+            "segments": format_items(annotation.segments, geometry_format),
+            "leaves": format_items(annotation.leaves, geometry_format),
+            "stems": format_items(annotation.stems, geometry_format),
+        })
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
 class MockSubscribeView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
@@ -434,12 +478,34 @@ class AnnotateMessageView(APIView):
 
         model_name = request.data.get('model_name', None)
 
-        # ПЕРЕДАЕМ ФЛАГИ deep_scan И bake_overlay В ML-КЛИЕНТ
-        annotated_file, segments, leaves, stems, extra_metrics = get_annotated_image(
-            message.image, user_conf, user_iou, user_imgsz, c_leaf, c_root, c_stem, deep_scan, bake_overlay, user=user, model_name=model_name
-        )
+        # Те же параметры анализа уже размечались — меняются только цвета / bake_overlay:
+        # просим ML-сервис перекрасить сохранённые маски, геометрию берём из прошлой разметки
+        previous = message.annotations.filter(
+            conf=user_conf, iou=user_iou, imgsz=user_imgsz,
+            is_deep_scan=deep_scan, model_name=model_name or '',
+        ).first()
+        annotated_file = None
+        if previous:
+            annotated_file = render_annotated_image(
+                message.image, user_conf, user_iou, user_imgsz, c_leaf, c_root, c_stem, deep_scan, bake_overlay, user=user, model_name=model_name
+            )
+            message.image.seek(0)
+        if annotated_file:
+            segments, leaves, stems = previous.segments, previous.leaves, previous.stems
+            extra_metrics = {
+                'leaf_area_cm2': previous.leaf_area_cm2,
+                'stem_length_mm': previous.stem_length_mm,
+                'is_baked': bake_overlay,
+                'cache_hit': True,
+            }
+        else:
+            # ПЕРЕДАЕМ ФЛАГИ deep_scan И bake_overlay В ML-КЛИЕНТ
+            annotated_file, segments, leaves, stems, extra_metrics = get_annotated_image(
+                message.image, user_conf, user_iou, user_imgsz, c_leaf, c_root, c_stem, deep_scan, bake_overlay, user=user, model_name=model_name
+            )
 
         if annotated_file:
+            geometry_format = request.data.get('geometry', 'json')
             new_ann = MessageAnnotation.objects.create(
                 message=message, image=annotated_file,
                 conf=user_conf, iou=user_iou, imgsz=user_imgsz,
@@ -457,14 +523,15 @@ class AnnotateMessageView(APIView):
                 "id": new_ann.id,
                 "annotated_image_url": request.build_absolute_uri(new_ann.image.url),
                 "conf": new_ann.conf, "iou": new_ann.iou, "imgsz": new_ann.imgsz,
-                "segments": new_ann.segments,
-                "leaves": new_ann.leaves,
-                "stems": new_ann.stems,
+                "segments": format_items(new_ann.segments, geometry_format),
+                "leaves": format_items(new_ann.leaves, geometry_format),
+                "stems": format_items(new_ann.stems, geometry_format),
                 "leaf_area_cm2": extra_metrics.get('leaf_area_cm2', 0.0),
                 "stem_length_mm": extra_metrics.get('stem_length_mm', 0.0),
                 "is_deep_scan": deep_scan,
                 "is_baked": bake_overlay,
                 "model_name": model_name or '',
+                "cache_hit": extra_metrics.get('cache_hit', False),
             })
 
         return Response({"error": "Не удалось сгенерировать разметку"}, status=status.HTTP_400_BAD_REQUEST)
@@ -494,6 +561,7 @@ class CalibrateView(APIView):
             user.calib_mm_per_pixel = result['mm_per_pixel']
             user.calib_cm2_per_pixel = result['cm2_per_pixel']
             user.calib_reprojection_error = result['reprojection_error']
+            user.calib_profile_id = result.get('calibration_id', '')
             user.save()
 
         return Response(result)
@@ -505,6 +573,7 @@ class CalibrateView(APIView):
         user.calib_mm_per_pixel = None
         user.calib_cm2_per_pixel = None
         user.calib_reprojection_error = None
+        user.calib_profile_id = ''
         user.save()
         return Response({"status": "reset", "message": "Калибровка сброшена к стандартной"})
 
@@ -163,4 +163,10 @@ CHANNEL_LAYERS = {
             "hosts": [('redis-cache', 6379)], # Имя сервиса Redis из docker-compose
         },
     },
-}
\ No newline at end of file
+}
+# Очередь анализов (Celery поверх того же Redis): воркеры ходят в ML-сервис,
+# HTTP-запрос на создание анализа сразу возвращает 202
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://redis-cache:6379/1')
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_TASK_IGNORE_RESULT = True
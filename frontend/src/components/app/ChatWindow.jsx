@@ -2,7 +2,7 @@ import React, { useEffect, useRef, useState } from 'react';
 import { useWebSocket } from '../../hooks/useWebSocket';
 import Message from '../chat/Message';
 import ChatInput from '../chat/ChatInput';
-import apiClient from '../../services/apiClient';
+import { getChatSessionDetails } from '../../services/apiClient';
 import AILabModal from '../chat/AILabModal';
 
 const ChatWindow = ({ activeChatId, chatLogic }) => {
@@ -33,7 +33,7 @@ const ChatWindow = ({ activeChatId, chatLogic }) => {
 
       setIsLoading(true);
       try {
-        const response = await apiClient.get(`/chat/${currentChatId}/`);
+        const response = await getChatSessionDetails(currentChatId);
         const history = Array.isArray(response.data) ? response.data : (response.data?.messages || []);
         setMessages(history);
       } catch (error) {
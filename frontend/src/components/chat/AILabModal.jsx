@@ -1,5 +1,5 @@
 import React, { useState, useEffect } from 'react';
-import { getAnnotatedImage, getUserProfile, updateUserProfile, getAvailableModels } from '../../services/apiClient';
+import { getAnnotatedImage, getAnnotationGeometry, getUserProfile, updateUserProfile, getAvailableModels } from '../../services/apiClient';
 import InteractivePlantCanvas from './InteractivePlantCanvas';
 
 const AILabModal = ({ isOpen, onClose, messageId, initialImage, initialAnnotations = [], onAnnotationCreated }) => {
@@ -67,6 +67,19 @@ const AILabModal = ({ isOpen, onClose, messageId, initialImage, initialAnnotatio
     }).catch(err => console.error("Failed to load models:", err));
   }, [initialAnnotations]);
 
+  // История приходит без контуров — догружаем геометрию активной версии при первом показе
+  const activeAnnotation = localAnnotations[activeIndex];
+  useEffect(() => {
+    if (!isOpen || !activeAnnotation || activeAnnotation.is_baked || activeAnnotation.segments) return;
+    let cancelled = false;
+    getAnnotationGeometry(activeAnnotation.id).then(res => {
+      if (cancelled) return;
+      const { segments, leaves, stems } = res.data;
+      setLocalAnnotations(prev => prev.map(a => a.id === activeAnnotation.id ? { ...a, segments, leaves, stems } : a));
+    }).catch(err => console.error("Failed to load geometry:", err));
+    return () => { cancelled = true; };
+  }, [isOpen, activeAnnotation?.id, activeAnnotation?.segments]);
+
   // Эффект для динамического лоадера DeepScan
   useEffect(() => {
     let interval;
@@ -37,7 +37,8 @@ export const useChat = (activeChatId, onNewChatCreated) => {
           const response = await uploadPlantPhoto(file);
           const data = response.data;
           uploaded++;
-          if (data.status === 'COMPLETED' && data.session_id) {
+          // Анализ идёт в очереди (202, PENDING) — результат придёт в чат по WebSocket
+          if (data.status !== 'FAILED' && data.session_id) {
             lastSessionId = data.session_id;
           }
           if (files.length > 1) {
@@ -1,4 +1,5 @@
 import axios from 'axios';
+import { decodeAnnotation } from './geometry';
 
 const apiClient = axios.create({
   baseURL: "/api",
@@ -24,7 +25,15 @@ export const changePassword = (passwordData) => apiClient.post('/auth/change-pas
 
 // Чат и фото (FloraAI)
 export const getChatSessions = () => apiClient.get('/chat/');
-export const getChatSessionDetails = (sessionId) => sessionId ? apiClient.get(`/chat/${sessionId}/`) : Promise.resolve(null);
+// История чата без контуров: у разметок только метаданные и geometry_url, контуры — getAnnotationGeometry
+export const getChatSessionDetails = (sessionId) => sessionId ? apiClient.get(`/chat/${sessionId}/`, { params: { annotations: 'slim' } }) : Promise.resolve(null);
+// Геометрия запрашивается компактной (path_enc) и раскладывается в path на клиенте; повторные запросы
+// браузер ревалидирует по ETag (304 без тела)
+export const getAnnotationGeometry = (annotationId) =>
+  apiClient.get(`/chat/annotation/${annotationId}/geometry/`, { params: { geometry: 'compact' } }).then((response) => {
+    response.data = decodeAnnotation(response.data);
+    return response;
+  });
 export const deleteChatSession = (sessionId) => apiClient.delete(`/chat/${sessionId}/`);
 
 export const uploadPlantPhoto = (file) => {
@@ -44,9 +53,12 @@ export const sendFloraChatMessage = (text, metrics, sessionId = null) => {
 };
 
 export const getAnnotatedImage = (messageId, isDeepScan = false, isBaked = false, modelName = null) => {
-    const payload = { deep_scan: isDeepScan, bake_overlay: isBaked };
+    const payload = { deep_scan: isDeepScan, bake_overlay: isBaked, geometry: 'compact' };
     if (modelName) payload.model_name = modelName;
-    return apiClient.post(`/chat/message/${messageId}/annotate/`, payload);
+    return apiClient.post(`/chat/message/${messageId}/annotate/`, payload).then((response) => {
+      response.data = decodeAnnotation(response.data);
+      return response;
+    });
 };
 
 export const getAvailableModels = () => apiClient.get('/ml/models/');
@@ -0,0 +1,48 @@
+// Декодер компактной геометрии разметки (формат ML-сервиса и backend api/services/geometry.py):
+// path_enc — base64 от zigzag-varint последовательности x0, y0, dx1, dy1, ...
+
+export const decodePath = (encoded) => {
+  const bytes = atob(encoded);
+  const points = [];
+  let value = 0;
+  let shift = 0;
+  let pending = null;
+  let x = 0;
+  let y = 0;
+
+  for (let i = 0; i < bytes.length; i++) {
+    const byte = bytes.charCodeAt(i);
+    // Умножение вместо << — координаты со знаком не помещаются в 32-битные побитовые операции после 4 байт
+    value += (byte & 0x7f) * 2 ** shift;
+    if (byte & 0x80) {
+      shift += 7;
+      continue;
+    }
+    const delta = value % 2 === 0 ? value / 2 : -(value + 1) / 2;
+    value = 0;
+    shift = 0;
+
+    if (pending === null) {
+      pending = delta;
+    } else {
+      x += pending;
+      y += delta;
+      points.push([x, y]);
+      pending = null;
+    }
+  }
+  return points;
+};
+
+export const decodeItems = (items) => (items || []).map((item) => {
+  if (item.path_enc === undefined) return item;
+  const { path_enc, ...rest } = item;
+  return { ...rest, path: decodePath(path_enc) };
+});
+
+export const decodeAnnotation = (annotation) => ({
+  ...annotation,
+  segments: decodeItems(annotation.segments),
+  leaves: decodeItems(annotation.leaves),
+  stems: decodeItems(annotation.stems),
+});
@@ -20,21 +20,31 @@ FloraAI — CLI-скрипт для инференса (обработка из
     # Указать папку вывода:
     python cli_inference.py image.jpg -o results/
 
+    # Архив на ночь: 4 потока, результаты построчно в output/results.jsonl,
+    # повторный запуск пропускает уже обработанные фото:
+    python cli_inference.py /archive/scans/ --workers 4 --model best_aug_scratch_s.pt@onnx
+
     # Настроить параметры YOLO:
     python cli_inference.py image.jpg --conf 0.3 --iou 0.5 --imgsz 1280
 """
 
 import argparse
+import contextlib
+import csv
 import json
 import os
 import sys
+import time
 import glob as glob_module
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Optional
 
 import cv2
 import numpy as np
 
-# Импортируем функцию анализа из основного модуля
-from main import analyze_biomass
+# Импортируем анализ и реестр моделей из основного модуля
+from main import (analyze_biomass, registry, micro_batcher, MicroBatcher, BatchedModel, _json_default,
+                  MICRO_BATCH_MAX_SIZE, MICRO_BATCH_WINDOW_MS)
 
 
 IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.webp'}
@@ -105,14 +115,151 @@ def format_metrics_table(metrics: dict) -> str:
     return "\n".join(lines)
 
 
-def process_image(image_path: str, args) -> dict:
-    """Обрабатывает одно изображение и возвращает метрики."""
+HEAVY_KEYS = ('segments', 'leaves', 'stems', 'annotated_image_base64')
+
+# Схема таблиц: набор скалярных метрик analyze_biomass фиксирован (часть ключей появляется
+# в metrics только при найденных корнях/стеблях, в таблице это пустые ячейки).
+SUMMARY_COLUMNS = [
+    ('image', 'str'), ('status', 'str'), ('error', 'str'), ('plant_type', 'str'), ('is_tiled', 'bool'),
+    ('leaf_count', 'int'), ('leaf_area_cm2', 'float'), ('leaf_perimeter_mm', 'float'),
+    ('leaf_exgreen', 'float'), ('leaf_vari', 'float'),
+    ('stem_count', 'int'), ('stem_length_mm', 'float'), ('stem_area_mm2', 'float'),
+    ('stem_base_width_mm', 'float'), ('stem_tip_width_mm', 'float'), ('stem_taper_ratio', 'float'),
+    ('root_anchors', 'int'), ('primary_root_len_mm', 'float'), ('primary_root_vol_mm3', 'float'),
+    ('lateral_root_len_mm', 'float'), ('lateral_root_vol_mm3', 'float'),
+    ('total_root_len_mm', 'float'), ('total_root_vol_mm3', 'float'), ('root_length_mm', 'float'),
+    ('root_area_mm2', 'float'), ('root_surface_area_mm2', 'float'),
+    ('root_tip_count', 'int'), ('root_fork_count', 'int'), ('lateral_root_count', 'int'),
+    ('branching_intensity', 'float'), ('root_system_width_mm', 'float'), ('root_system_depth_mm', 'float'),
+    ('width_depth_ratio', 'float'), ('root_density', 'float'), ('root_fractal_dimension', 'float'),
+    ('specific_root_length', 'float'),
+]
+SEGMENT_COLUMNS = [
+    ('image', 'str'), ('id', 'int'), ('type', 'str'),
+    ('length_mm', 'float'), ('thickness_mm', 'float'), ('volume_mm3', 'float'),
+]
+_CASTS = {'str': str, 'int': int, 'float': float, 'bool': bool}
+
+
+class TableWriter:
+    """Потоковая запись строк в .csv / .parquet: строки копятся до chunk_rows и сбрасываются
+    одним куском (для parquet — row group), память не зависит от числа фото."""
+
+    def __init__(self, path: str, columns: list, chunk_rows: int = 5000):
+        self.path = path
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.rows = []
+        self.is_parquet = path.lower().endswith('.parquet')
+
+        if self.is_parquet:
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                sys.exit("Для записи .parquet нужен pyarrow (pip install pyarrow) или укажите .csv")
+            types = {'str': pa.string(), 'int': pa.int64(), 'float': pa.float64(), 'bool': pa.bool_()}
+            self._pa = pa
+            self._schema = pa.schema([(name, types[kind]) for name, kind in columns])
+            self._writer = pq.ParquetWriter(path, self._schema)
+        else:
+            self._file = open(path, 'w', newline='', encoding='utf-8')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow([name for name, _ in columns])
+
+    def write(self, row: dict):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.is_parquet:
+            data = {
+                name: [None if r.get(name) is None else _CASTS[kind](r[name]) for r in self.rows]
+                for name, kind in self.columns
+            }
+            self._writer.write_table(self._pa.Table.from_pydict(data, schema=self._schema))
+        else:
+            self._writer.writerows([[r.get(name) for name, _ in self.columns] for r in self.rows])
+        self.rows.clear()
+
+    def close(self):
+        self.flush()
+        if self.is_parquet:
+            self._writer.close()
+        else:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export_tables(jsonl_path: str, table_path: Optional[str], segments_path: Optional[str], chunk_rows: int) -> int:
+    """results.jsonl → таблица фото (+ таблица сегментов корней). Читается построчно; ошибка
+    попадает в таблицу один раз и только если фото так и не обработалось при повторных запусках."""
+    done = load_done(jsonl_path)
+    failed = set()
+    rows = 0
+    with contextlib.ExitStack() as stack:
+        table = stack.enter_context(TableWriter(table_path, SUMMARY_COLUMNS, chunk_rows)) if table_path else None
+        segments = stack.enter_context(TableWriter(segments_path, SEGMENT_COLUMNS, chunk_rows)) if segments_path else None
+        with open(jsonl_path, encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                image = record['image']
+                if record['status'] != 'ok':
+                    if table is not None and image not in done and image not in failed:
+                        failed.add(image)
+                        table.write(record)
+                        rows += 1
+                    continue
+                metrics = record['metrics']
+                if table is not None:
+                    table.write({**metrics, 'image': image, 'status': 'ok'})
+                    rows += 1
+                if segments is not None:
+                    for segment in metrics.get('segments', []):
+                        segments.write({**segment, 'image': image})
+    return rows
+
+
+def load_done(jsonl_path: str) -> set[str]:
+    """Фото, для которых в JSONL уже есть успешный результат (для продолжения прерванного прогона).
+    Недописанная последняя строка (прогон убит посреди записи) отрезается."""
+    done = set()
+    if not os.path.exists(jsonl_path):
+        return done
+    with open(jsonl_path, 'rb+') as f:
+        valid_end = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            valid_end += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('status') == 'ok':
+                done.add(record['image'])
+        f.truncate(valid_end)
+    return done
+
+
+def process_image(image_path: str, yolo_model, args) -> dict:
+    """Обрабатывает одно изображение и возвращает метрики (без полигонов).
+    Выполняется в потоке воркера: чтение, постобработка и запись оверлея идут параллельно,
+    сам инференс YOLO уходит в общий MicroBatcher."""
     img = cv2.imread(image_path)
     if img is None:
-        print(f"  [!] Не удалось прочитать: {image_path}")
-        return None
+        raise ValueError("не удалось прочитать изображение")
 
     metrics, annotated = analyze_biomass(
+        yolo_model,
         img,
         conf=args.conf,
         iou=args.iou,
@@ -127,19 +274,53 @@ def process_image(image_path: str, args) -> dict:
         base = os.path.splitext(os.path.basename(image_path))[0]
         out_path = os.path.join(args.output, f"{base}_annotated.jpg")
         cv2.imwrite(out_path, annotated)
-        print(f"  -> Аннотация сохранена: {out_path}")
-
-    # Сохраняем JSON с метриками
-    base = os.path.splitext(os.path.basename(image_path))[0]
-    json_path = os.path.join(args.output, f"{base}_metrics.json")
-
-    # Убираем полигоны из JSON для читаемости (они огромные)
-    metrics_clean = {k: v for k, v in metrics.items()
-                     if k not in ('segments', 'leaves', 'stems', 'annotated_image_base64')}
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(metrics_clean, f, ensure_ascii=False, indent=2)
 
-    return metrics
+    # Убираем полигоны для читаемости (они огромные); у сегментов корней остаются скалярные поля
+    result = {k: v for k, v in metrics.items() if k not in HEAVY_KEYS}
+    result['segments'] = [{k: v for k, v in seg.items() if k != 'path'} for seg in metrics['segments']]
+    return result
+
+
+def run_batch(images: list[str], yolo_model, args, out) -> int:
+    """Пул воркеров над списком фото; в работе не больше workers*2 фото, чтобы память
+    не росла с размером архива. Результаты пишутся в JSONL по мере готовности."""
+    processed = 0
+    started = time.monotonic()
+    pending = {}
+    queue = iter(images)
+
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="cli") as executor:
+        def submit_next():
+            path = next(queue, None)
+            if path is not None:
+                pending[executor.submit(process_image, path, yolo_model, args)] = path
+
+        for _ in range(args.workers * 2):
+            submit_next()
+
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path = pending.pop(future)
+                submit_next()
+                processed += 1
+                try:
+                    metrics = future.result()
+                    record = {"image": path, "status": "ok", "metrics": metrics}
+                except Exception as e:
+                    metrics = None
+                    record = {"image": path, "status": "error", "error": str(e)}
+
+                out.write(json.dumps(record, ensure_ascii=False, default=_json_default) + "\n")
+                out.flush()
+
+                rate = processed / max(time.monotonic() - started, 1e-6)
+                status = "OK" if metrics is not None else f"ОШИБКА: {record['error']}"
+                print(f"[{processed}/{len(images)}] {os.path.basename(path)} {status}  ({rate:.2f} фото/с)")
+                if metrics is not None and not args.json_only:
+                    print(format_metrics_table(metrics))
+                    print()
+    return processed
 
 
 def main():
@@ -154,6 +335,7 @@ def main():
   python cli_inference.py photo.jpg --deep-scan         # точный режим (TTA x8)
   python cli_inference.py photo.jpg --save-overlay      # сохранить аннотацию
   python cli_inference.py photo.jpg -o results/         # папка вывода
+  python cli_inference.py /archive/ --workers 4         # архив: пул потоков + results.jsonl
         """
     )
     parser.add_argument('inputs', nargs='+', help='Изображения или папки с изображениями')
@@ -164,6 +346,13 @@ def main():
     parser.add_argument('--deep-scan', action='store_true', help='DeepScan: 8-кратный TTA ансамблинг (точнее, но медленнее)')
     parser.add_argument('--save-overlay', action='store_true', help='Сохранить аннотированные изображения с масками')
     parser.add_argument('--json-only', action='store_true', help='Только JSON-вывод (без таблицы в консоль)')
+    parser.add_argument('--model', default=None, help='Модель из MODELS_DIR, можно с бэкендом: name.pt@onnx (default: DEFAULT_MODEL)')
+    parser.add_argument('--workers', type=int, default=4, help='Потоков чтения/постобработки (default: 4)')
+    parser.add_argument('--jsonl', default=None, help='Файл результатов JSONL (default: <output>/results.jsonl)')
+    parser.add_argument('--no-resume', action='store_true', help='Не пропускать фото, уже записанные в JSONL')
+    parser.add_argument('--table', default=None, help='Таблица метрик, строка на фото: .csv или .parquet')
+    parser.add_argument('--segments-table', default=None, help='Таблица сегментов корней, строка на сегмент: .csv или .parquet')
+    parser.add_argument('--table-chunk-rows', type=int, default=5000, help='Строк в одном сбрасываемом куске таблицы (default: 5000)')
 
     args = parser.parse_args()
 
@@ -182,35 +371,29 @@ def main():
     print(f"Найдено изображений: {len(images)}")
     print(f"Результаты: {os.path.abspath(args.output)}/\n")
 
-    all_metrics = {}
-
-    for i, img_path in enumerate(images, 1):
-        name = os.path.basename(img_path)
-        print(f"[{i}/{len(images)}] {name} ...", end=" ", flush=True)
-
-        metrics = process_image(img_path, args)
-        if metrics is None:
-            continue
-
-        print("OK")
-        all_metrics[name] = metrics
-
-        if not args.json_only:
-            print(format_metrics_table(metrics))
-            print()
-
-    # Сводный JSON для пакетной обработки
-    if len(images) > 1:
-        summary_path = os.path.join(args.output, '_batch_summary.json')
-        summary = {}
-        for name, m in all_metrics.items():
-            summary[name] = {k: v for k, v in m.items()
-                             if k not in ('segments', 'leaves', 'stems', 'annotated_image_base64')}
-        with open(summary_path, 'w', encoding='utf-8') as f:
-            json.dump(summary, f, ensure_ascii=False, indent=2)
-        print(f"Сводка пакетной обработки: {summary_path}")
-
-    print(f"\nГотово! Обработано {len(all_metrics)}/{len(images)} изображений.")
+    jsonl_path = args.jsonl or os.path.join(args.output, 'results.jsonl')
+    if args.no_resume and os.path.exists(jsonl_path):
+        os.remove(jsonl_path)
+    done = load_done(jsonl_path)
+    todo = [p for p in images if os.path.abspath(p) not in done]
+    if done:
+        print(f"Уже обработано ранее: {len(images) - len(todo)}, осталось: {len(todo)}\n")
+
+    # Несколько воркеров на одной модели: вызовы YOLO сериализуются (и склеиваются в батчи)
+    # через MicroBatcher, постобработка идёт параллельно.
+    batcher = micro_batcher or MicroBatcher(MICRO_BATCH_MAX_SIZE if args.workers > 1 else 1, MICRO_BATCH_WINDOW_MS)
+    with registry.use(args.model) as model, open(jsonl_path, 'a', encoding='utf-8') as out:
+        yolo_model = BatchedModel(batcher, registry.canonical_name(args.model), model)
+        processed = run_batch([os.path.abspath(p) for p in todo], yolo_model, args, out)
+
+    print(f"\nГотово! Обработано {processed}/{len(todo)} изображений. Результаты: {jsonl_path}")
+
+    if args.table or args.segments_table:
+        rows = export_tables(jsonl_path, args.table, args.segments_table, args.table_chunk_rows)
+        if args.table:
+            print(f"Таблица метрик: {args.table} ({rows} строк)")
+        if args.segments_table:
+            print(f"Таблица сегментов: {args.segments_table}")
 
 
 if __name__ == '__main__':
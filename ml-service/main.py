@@ -1,7 +1,9 @@
-import os, base64, glob, json
-from collections import OrderedDict
+import os, ast, base64, glob, json, asyncio, threading, time, hashlib, zlib, contextlib, uuid
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Response
+from starlette.background import BackgroundTask
 from ultralytics import YOLO
 import cv2
 import numpy as np
@@ -15,29 +17,230 @@ app = FastAPI()
 MODELS_DIR = os.getenv("MODELS_DIR", "models")
 DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "best_aug_scratch_s.pt")
 MAX_LOADED_MODELS = int(os.getenv("MAX_LOADED_MODELS", "2"))
+# Бэкенд инференса по умолчанию: torch | onnx | openvino. Конкретный бэкенд модели выбирается
+# суффиксом в model_name: "best.pt@onnx". Артефакты ищутся рядом с .pt (best.onnx,
+# best_openvino_model/); при EXPORT_ON_DEMAND=1 недостающий экспортируется при первом запросе.
+DEFAULT_BACKEND = os.getenv("DEFAULT_BACKEND", "torch")
+EXPORT_ON_DEMAND = int(os.getenv("EXPORT_ON_DEMAND", "0"))
+BACKENDS = ("torch", "onnx", "openvino")
+# Индекс метаданных чекпойнтов (train_args / train_metrics): перечитываются только .pt,
+# у которых изменились mtime или размер. MODELS_WATCH_INTERVAL_S — опрос папки моделей (0 — выкл.).
+MODEL_INDEX_FILE = os.getenv("MODEL_INDEX_FILE", os.path.join(MODELS_DIR, ".catalog_index.json"))
+MODELS_WATCH_INTERVAL_S = float(os.getenv("MODELS_WATCH_INTERVAL_S", 10))
+# Вытеснение по памяти: сумма измеренных parameters + buffers загруженных моделей (0 — только
+# MAX_LOADED_MODELS). PINNED_MODELS не вытесняются никогда (имя файла — все бэкенды, name@backend — один).
+MODEL_MEMORY_BUDGET_MB = float(os.getenv("MODEL_MEMORY_BUDGET_MB", 0))
+PINNED_MODELS = [n.strip() for n in os.getenv("PINNED_MODELS", DEFAULT_MODEL).split(",") if n.strip()]
+# Фоновая подгрузка моделей, часто встречающихся среди последних MODEL_PREFETCH_WINDOW запросов,
+# если они помещаются в бюджет без вытеснения (0 — выкл.)
+MODEL_PREFETCH_INTERVAL_S = float(os.getenv("MODEL_PREFETCH_INTERVAL_S", 30))
+MODEL_PREFETCH_WINDOW = int(os.getenv("MODEL_PREFETCH_WINDOW", 50))
+
+
+class _PendingLoad:
+    """Загрузка модели в процессе: остальные запросы той же модели ждут её, а не грузят вторую копию."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+
+class SerializedModel:
+    """Модель в реестре: forward pass идёт под замком этой модели. Предикторы ultralytics не
+    потокобезопасны, а один экземпляр вызывают потоки InferencePool (INFERENCE_WORKERS > 1),
+    MicroBatcher и воркеры CLI. Остальные атрибуты проксируются в YOLO.
+    Для статического экспорта (onnx / openvino без dynamic) список кадров режется на батчи
+    max_batch, а imgsz подменяется размером входа, с которым модель экспортирована."""
+
+    def __init__(self, yolo: YOLO, max_batch: int = 0, imgsz=None):
+        self.yolo = yolo
+        self.lock = threading.Lock()
+        self.max_batch = max_batch  # 0 — без ограничения
+        self.imgsz = imgsz
+
+    def __call__(self, source, *args, **kwargs):
+        if self.imgsz is not None and "imgsz" in kwargs:
+            kwargs["imgsz"] = self.imgsz
+        with self.lock:
+            if self.max_batch and isinstance(source, list) and len(source) > self.max_batch:
+                results = []
+                for start in range(0, len(source), self.max_batch):
+                    results.extend(self.yolo(source[start:start + self.max_batch], *args, **kwargs))
+                return results
+            return self.yolo(source, *args, **kwargs)
+
+    def __getattr__(self, item):
+        return getattr(self.yolo, item)
 
 
 class ModelRegistry:
-    def __init__(self, models_dir: str, default_model: str, max_loaded: int):
+    def __init__(self, models_dir: str, default_model: str, max_loaded: int, index_file: str = None,
+                 memory_budget_mb: float = 0, pinned: list = None, prefetch_window: int = 50):
         self.models_dir = models_dir
         self.default_model_name = default_model
         self.max_loaded = max_loaded
+        self.index_file = index_file
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.pinned = set(pinned or [])
         self.catalog: dict[str, dict] = {}
-        self._loaded: OrderedDict[str, YOLO] = OrderedDict()
+        self._loaded: OrderedDict[str, SerializedModel] = OrderedDict()
+        self._lock = threading.RLock()
+        self._sizes: dict[str, int] = {}       # измеренный размер модели в памяти, байт
+        self._counters: dict[str, dict] = {}   # hits / misses / loads / load_time_s / evictions / prefetches
+        self._recent = deque(maxlen=max(1, prefetch_window))
+        self._refs: dict[str, int] = {}                # запросы, которые сейчас используют модель
+        self._loading: dict[str, _PendingLoad] = {}    # single-flight: идущие загрузки
+        self._stale: set[str] = set()                  # загружены со старого чекпойнта, ждут выгрузки
+        self._scan_lock = threading.Lock()
+        self._snapshot: dict[str, tuple] = {}
         self.scan()
         # Pre-load default model
         self.get_model()
 
-    def scan(self):
-        self.catalog.clear()
-        pt_files = glob.glob(os.path.join(self.models_dir, "*.pt"))
+    def _model_files(self) -> dict[str, str]:
+        pt_files = sorted(glob.glob(os.path.join(self.models_dir, "*.pt")))
         if os.path.exists(self.default_model_name):
             pt_files.append(self.default_model_name)
+        files = {}
         for pt_path in pt_files:
-            name = os.path.basename(pt_path)
-            if name in self.catalog:
+            files.setdefault(os.path.basename(pt_path), pt_path)
+        return files
+
+    def _stat_snapshot(self) -> dict[str, tuple]:
+        snapshot = {}
+        for name, pt_path in self._model_files().items():
+            try:
+                st = os.stat(pt_path)
+            except OSError:
                 continue
-            self.catalog[name] = self._extract_metadata(pt_path)
+            snapshot[name] = (pt_path, st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def _load_index(self) -> dict:
+        if not self.index_file:
+            return {}
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self, index: dict):
+        if not self.index_file:
+            return
+        tmp_path = self.index_file + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(index, f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, self.index_file)
+        except OSError as e:
+            print(f"⚠️ Не удалось сохранить индекс моделей {self.index_file}: {e}")
+
+    def scan(self) -> dict:
+        """Пересобирает каталог. torch.load только для новых/изменённых чекпойнтов,
+        остальное — из индекса. Каталог подменяется целиком, запросы видят либо старый, либо новый."""
+        with self._scan_lock:
+            index = self._load_index()
+            snapshot = self._stat_snapshot()
+            catalog, new_index, reread = {}, {}, 0
+            for name, (pt_path, mtime_ns, size) in snapshot.items():
+                key = os.path.abspath(pt_path)
+                cached = index.get(key)
+                if cached and cached.get("mtime_ns") == mtime_ns and cached.get("size") == size:
+                    meta = {**cached["meta"], "path": pt_path}
+                else:
+                    meta = self._extract_metadata(pt_path)
+                    reread += 1
+                catalog[name] = meta
+                new_index[key] = {"mtime_ns": mtime_ns, "size": size, "meta": meta}
+
+            changed = {name for name, entry in self._snapshot.items() if snapshot.get(name) != entry}
+            with self._lock:
+                self.catalog = catalog
+                self._snapshot = snapshot
+                self._invalidate(changed)
+            if new_index != index:
+                self._save_index(new_index)
+            return {"count": len(catalog), "reread": reread,
+                    "removed": len([k for k in index if k not in new_index])}
+
+    def _invalidate(self, bases: set):
+        """Загруженные модели (все бэкенды) изменённых или удалённых чекпойнтов: свободные выгружаются
+        сразу, занятые запросами — в _release. Следующий _acquire грузит новые веса."""
+        for name in [n for n in self._loaded if n.partition("@")[0] in bases]:
+            self._sizes.pop(name, None)
+            if self._refs.get(name):
+                self._stale.add(name)
+            else:
+                self._unload(name, "чекпойнт изменён")
+
+    def start_watcher(self, interval_s: float):
+        """Фоновый опрос папки моделей: новые/изменённые/удалённые .pt появляются без рестарта."""
+        if interval_s <= 0:
+            return
+
+        def watch():
+            while True:
+                time.sleep(interval_s)
+                try:
+                    if self._stat_snapshot() != self._snapshot:
+                        result = self.scan()
+                        print(f"🔄 Каталог моделей обновлён: {result}")
+                except Exception as e:
+                    print(f"⚠️ Ошибка обновления каталога моделей: {e}")
+
+        threading.Thread(target=watch, name="models-watcher", daemon=True).start()
+
+    @staticmethod
+    def _artifact_path(pt_path: str, backend: str) -> str:
+        """Путь экспортированной модели в формате ultralytics export (рядом с .pt)."""
+        stem = os.path.splitext(pt_path)[0]
+        if backend == "onnx":
+            return stem + ".onnx"
+        if backend == "openvino":
+            return stem + "_openvino_model"
+        return pt_path
+
+    def _backends(self, pt_path: str) -> dict:
+        """ready — артефакт есть, on_demand — будет экспортирован при первом запросе."""
+        backends = {"torch": "ready"}
+        for backend in ("onnx", "openvino"):
+            if os.path.exists(self._artifact_path(pt_path, backend)):
+                backends[backend] = "ready"
+            elif EXPORT_ON_DEMAND:
+                backends[backend] = "on_demand"
+        return backends
+
+    def split_name(self, name: str = None) -> tuple[str, str]:
+        """"best.pt@onnx" → ("best.pt", "onnx"); без суффикса — DEFAULT_BACKEND,
+        если он доступен для модели, иначе torch."""
+        base, _, backend = (name or self.default_model_name).partition("@")
+        if base not in self.catalog:
+            raise ValueError(f"Модель '{base}' не найдена. Доступные: {list(self.catalog.keys())}")
+        if not backend:
+            backend = DEFAULT_BACKEND if DEFAULT_BACKEND in self._backends(self.catalog[base]["path"]) else "torch"
+        if backend not in BACKENDS:
+            raise ValueError(f"Неизвестный бэкенд '{backend}'. Доступные: {list(BACKENDS)}")
+        return base, backend
+
+    def canonical_name(self, name: str = None) -> str:
+        """Имя для ключей кэша и micro-batching: torch-модели без суффикса, остальные — name@backend."""
+        base, backend = self.split_name(name)
+        return base if backend == "torch" else f"{base}@{backend}"
+
+    def version(self, name: str = None) -> str:
+        """Версия весов для ключей кэша результатов: mtime и размер чекпойнта (и артефакта бэкенда)
+        из последнего скана. Переобученный .pt с тем же именем даёт новый ключ."""
+        base, backend = self.split_name(name)
+        _, mtime_ns, size = self._snapshot.get(base, (None, 0, 0))
+        version = f"{mtime_ns}:{size}"
+        if backend != "torch":
+            try:
+                st = os.stat(self._artifact_path(self.catalog[base]["path"], backend))
+                version += f":{st.st_mtime_ns}"
+            except OSError:
+                pass
+        return version
 
     def _extract_metadata(self, pt_path: str) -> dict:
         meta = {
@@ -61,36 +264,292 @@ class ModelRegistry:
             print(f"⚠️ Не удалось прочитать метаданные {pt_path}: {e}")
         return meta
 
-    def get_model(self, name: str = None) -> YOLO:
-        name = name or self.default_model_name
-        if name not in self.catalog:
-            raise ValueError(f"Модель '{name}' не найдена. Доступные: {list(self.catalog.keys())}")
-        if name in self._loaded:
-            self._loaded.move_to_end(name)
-            return self._loaded[name]
-        while len(self._loaded) >= self.max_loaded:
-            evicted_name, evicted_model = self._loaded.popitem(last=False)
-            del evicted_model
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            print(f"♻️ Выгружена модель '{evicted_name}' из GPU")
-        path = self.catalog[name]["path"]
+    @contextlib.contextmanager
+    def use(self, name: str = None):
+        """Модель на время запроса: пока блок выполняется, она не будет вытеснена."""
+        canonical, model = self._acquire(name)
+        try:
+            yield model
+        finally:
+            self._release(canonical)
+
+    def get_model(self, name: str = None) -> SerializedModel:
+        """Модель без удержания ссылки (прогрев, CLI). Для инференса в сервисе — use()."""
+        canonical, model = self._acquire(name)
+        self._release(canonical)
+        return model
+
+    def _acquire(self, name: str = None, record: bool = True) -> tuple[str, SerializedModel]:
+        """Возвращает (canonical_name, model) с увеличенным счётчиком ссылок. Если модель не загружена,
+        грузит её ровно один поток; остальные ждут его результат (single-flight). Загрузка идёт вне
+        self._lock — попадания в уже загруженные модели не ждут чужой загрузки."""
+        base, backend = self.split_name(name)
+        name = self.canonical_name(name)
+        first = True
+        while True:
+            with self._lock:
+                counters = self._counter(name)
+                if record and first:
+                    self._recent.append(name)
+                if name in self._loaded and name not in self._stale:
+                    self._loaded.move_to_end(name)
+                    if record and first:
+                        counters["hits"] += 1
+                    self._refs[name] = self._refs.get(name, 0) + 1
+                    return name, self._loaded[name]
+                if record and first:
+                    counters["misses"] += 1
+                first = False
+                pending = self._loading.get(name)
+                owner = pending is None
+                if owner:
+                    pending = self._loading[name] = _PendingLoad()
+
+            if owner:
+                try:
+                    return name, self._load(name, base, backend)
+                except BaseException as e:
+                    pending.error = e
+                    raise
+                finally:
+                    with self._lock:
+                        self._loading.pop(name, None)
+                    pending.done.set()
+
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            # Модель загружена — следующий виток возьмёт на неё ссылку (или загрузит заново,
+            # если её успели вытеснить)
+
+    def _release(self, name: str):
+        with self._lock:
+            refs = self._refs.get(name, 0) - 1
+            if refs > 0:
+                self._refs[name] = refs
+                return
+            self._refs.pop(name, None)
+            if name in self._stale:
+                self._unload(name, "чекпойнт изменён")
+            # Вытеснение, отложенное пока модель была занята
+            self._evict(quiet=True)
+
+    def _counter(self, name: str) -> dict:
+        return self._counters.setdefault(name, {
+            "hits": 0, "misses": 0, "loads": 0, "load_time_s": 0.0, "last_load_s": None,
+            "evictions": 0, "prefetches": 0,
+        })
+
+    def _load(self, name: str, base: str, backend: str) -> SerializedModel:
+        """Вызывается только владельцем _PendingLoad. Место освобождается по оценке размера до
+        загрузки и по измеренному после; модель возвращается уже со ссылкой."""
+        path = self._resolve_artifact(base, backend)
+        with self._lock:
+            self._evict(incoming=self._sizes.get(name) or self._estimate_size(path), extra_models=1)
         print(f"📦 Загрузка модели '{name}' из {path}...")
-        self._loaded[name] = YOLO(path)
-        return self._loaded[name]
+        started = time.perf_counter()
+        model = YOLO(path, task="segment")
+        elapsed = time.perf_counter() - started
+        size = self._measure_size(model, path)
+        export_args = self._export_args(path, backend)
+        if export_args:
+            print(f"📐 '{name}' экспортирована со статическим входом: батч {export_args['max_batch']}, "
+                  f"imgsz {export_args['imgsz']}")
+        model = SerializedModel(model, **export_args)
+
+        with self._lock:
+            self._sizes[name] = size
+            # Устаревшую копию держат только запросы, начатые до скана
+            self._stale.discard(name)
+            self._loaded.pop(name, None)
+            self._loaded[name] = model
+            self._refs[name] = self._refs.get(name, 0) + 1
+            counters = self._counter(name)
+            counters["loads"] += 1
+            counters["load_time_s"] = round(counters["load_time_s"] + elapsed, 3)
+            counters["last_load_s"] = round(elapsed, 3)
+            self._evict()
+        return model
+
+    def is_pinned(self, name: str) -> bool:
+        return name in self.pinned or name.partition("@")[0] in self.pinned
+
+    def _used_bytes(self) -> int:
+        return sum(self._sizes.get(name, 0) for name in self._loaded)
+
+    def _fits(self, incoming: int, extra_models: int) -> bool:
+        if self.max_loaded > 0 and len(self._loaded) + extra_models > self.max_loaded:
+            return False
+        return self.memory_budget <= 0 or self._used_bytes() + incoming <= self.memory_budget
+
+    def _evict(self, incoming: int = 0, extra_models: int = 0, quiet: bool = False):
+        """LRU-вытеснение незакреплённых и не используемых запросами моделей, пока не выполнены лимит
+        MAX_LOADED_MODELS и бюджет памяти (incoming / extra_models — ещё не загруженная модель).
+        Если вытеснять больше некого — остаёмся сверх бюджета, а не отказываем в запросе."""
+        while not self._fits(incoming, extra_models):
+            victim = next((n for n in self._loaded if not self.is_pinned(n) and not self._refs.get(n)), None)
+            if victim is None:
+                if not quiet:
+                    print(f"⚠️ Бюджет моделей превышен: {self._used_bytes() / 1024 / 1024:.0f} МБ, "
+                          f"вытеснять некого (закреплены: {sorted(self.pinned)}, в работе: {sorted(self._refs)})")
+                return
+            self._unload(victim)
+
+    def _unload(self, name: str, reason: str = None):
+        evicted_model = self._loaded.pop(name)
+        del evicted_model
+        self._stale.discard(name)
+        self._counter(name)["evictions"] += 1
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print(f"♻️ Выгружена модель '{name}' из GPU" + (f" ({reason})" if reason else ""))
+
+    @staticmethod
+    def _disk_size(path: str) -> int:
+        if os.path.isdir(path):
+            return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+        return os.path.getsize(path)
+
+    @classmethod
+    def _estimate_size(cls, path: str) -> int:
+        # В .pt веса лежат в fp16, в памяти — fp32
+        size = cls._disk_size(path)
+        return size * 2 if path.endswith(".pt") else size
+
+    @classmethod
+    def _measure_size(cls, model: YOLO, path: str) -> int:
+        """parameters + buffers torch-модели; для onnx / openvino — размер артефакта."""
+        module = getattr(model, "model", None)
+        if isinstance(module, torch.nn.Module):
+            tensors = list(module.parameters()) + list(module.buffers())
+            return sum(t.numel() * t.element_size() for t in tensors)
+        return cls._disk_size(path)
+
+    @staticmethod
+    def _export_args(path: str, backend: str) -> dict:
+        """Ограничения статического экспорта из метаданных ultralytics (batch, imgsz, args.dynamic):
+        {"max_batch", "imgsz"} для SerializedModel. Пусто — torch, dynamic-экспорт или метаданные
+        не прочитаны."""
+        if backend == "torch":
+            return {}
+        try:
+            if backend == "onnx":
+                import onnxruntime
+                session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+                raw = session.get_modelmeta().custom_metadata_map
+                del session
+                # ultralytics пишет значения как str(python-объекта)
+                meta = {k: ast.literal_eval(v) if k in ("batch", "imgsz", "args") else v for k, v in raw.items()}
+            else:
+                import yaml
+                with open(os.path.join(path, "metadata.yaml"), "r", encoding="utf-8") as f:
+                    meta = yaml.safe_load(f) or {}
+        except Exception as e:
+            print(f"⚠️ Не удалось прочитать метаданные экспорта {path}: {e}")
+            return {}
+        # Без args — старый экспорт ultralytics, по умолчанию статический
+        if (meta.get("args") or {}).get("dynamic"):
+            return {}
+        imgsz = meta.get("imgsz")
+        return {"max_batch": max(1, int(meta.get("batch") or 1)), "imgsz": list(imgsz) if imgsz else None}
+
+    def start_prefetcher(self, interval_s: float):
+        """Фоновая подгрузка часто запрашиваемых моделей, которые сейчас не в памяти."""
+        if interval_s <= 0:
+            return
+
+        def prefetch():
+            while True:
+                time.sleep(interval_s)
+                try:
+                    self.prefetch_once()
+                except Exception as e:
+                    print(f"⚠️ Ошибка предзагрузки модели: {e}")
+
+        threading.Thread(target=prefetch, name="models-prefetch", daemon=True).start()
+
+    def prefetch_once(self):
+        """Одна модель за тик: самая частая среди последних запросов (≥ 2 раз), если артефакт уже
+        есть на диске и она помещается без вытеснения."""
+        candidate = None
+        with self._lock:
+            for name, count in Counter(self._recent).most_common():
+                if count < 2:
+                    break
+                if name in self._loaded or name in self._loading:
+                    continue
+                try:
+                    base, backend = self.split_name(name)
+                except ValueError:
+                    continue
+                path = self._artifact_path(self.catalog[base]["path"], backend)
+                if not os.path.exists(path):
+                    continue
+                if self._fits(self._sizes.get(name) or self._estimate_size(path), extra_models=1):
+                    candidate = (name, count)
+                    break
+        if candidate is None:
+            return
+
+        name, count = candidate
+        print(f"🔮 Предзагрузка модели '{name}' ({count} из {len(self._recent)} последних запросов)")
+        canonical, _ = self._acquire(name, record=False)
+        self._release(canonical)
+        with self._lock:
+            self._counter(canonical)["prefetches"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_loaded": self.max_loaded,
+                "memory_budget_mb": round(self.memory_budget / 1024 / 1024, 1),
+                "used_mb": round(self._used_bytes() / 1024 / 1024, 1),
+                "pinned": sorted(self.pinned),
+                "loaded": list(self._loaded),
+                "in_use": dict(self._refs),
+                "loading": list(self._loading),
+            }
+
+    def _resolve_artifact(self, base: str, backend: str) -> str:
+        pt_path = self.catalog[base]["path"]
+        path = self._artifact_path(pt_path, backend)
+        if os.path.exists(path):
+            return path
+        if not EXPORT_ON_DEMAND:
+            raise ValueError(f"Для модели '{base}' нет артефакта {backend} ({path}), EXPORT_ON_DEMAND выключен")
+        # dynamic=True — вход произвольного imgsz и батча (пользовательский imgsz, тайлы, DeepScan-батчи)
+        print(f"🛠️ Экспорт '{base}' в {backend}...")
+        exported = YOLO(pt_path).export(format=backend, dynamic=True)
+        return str(exported)
 
     def list_models(self) -> list[dict]:
+        with self._lock:
+            return self._list_models()
+
+    def _list_models(self) -> list[dict]:
         result = []
         for name, meta in self.catalog.items():
             entry = {**meta}
             entry["is_default"] = (name == self.default_model_name)
-            entry["is_loaded"] = (name in self._loaded)
+            entry["backends"] = self._backends(meta["path"])
+            entry["loaded_backends"] = [
+                loaded.partition("@")[2] or "torch" for loaded in self._loaded if loaded.partition("@")[0] == name
+            ]
+            entry["is_loaded"] = bool(entry["loaded_backends"])
+            entry["is_pinned"] = self.is_pinned(name)
+            entry["counters"] = {
+                counted.partition("@")[2] or "torch": {**c, "size_mb": round(self._sizes.get(counted, 0) / 1024 / 1024, 1)}
+                for counted, c in self._counters.items() if counted.partition("@")[0] == name
+            }
             result.append(entry)
         return result
 
 
 print("🚀 Инициализация Flora AI ML Service (с поддержкой DeepScan)...")
-registry = ModelRegistry(MODELS_DIR, DEFAULT_MODEL, MAX_LOADED_MODELS)
+registry = ModelRegistry(MODELS_DIR, DEFAULT_MODEL, MAX_LOADED_MODELS, MODEL_INDEX_FILE,
+                         MODEL_MEMORY_BUDGET_MB, PINNED_MODELS, MODEL_PREFETCH_WINDOW)
+registry.start_watcher(MODELS_WATCH_INTERVAL_S)
+registry.start_prefetcher(MODEL_PREFETCH_INTERVAL_S)
 
 # --- 1. НАСТРОЙКИ ---
 YOLO_CONF = float(os.getenv("YOLO_CONF", 0.1))
@@ -102,11 +561,651 @@ CM2_PER_PIXEL = float(os.getenv("CALIB_CM2_PER_PX", 0.000114))
 MIN_ROOT_LENGTH_MM = 2.0
 MICRO_SEGMENT_PX = 5
 
+# DeepScan: сколько TTA-вариантов подаётся в YOLO за один forward pass.
+# 8 = все аугментации одним батчем, 1 = старый поштучный режим (минимум памяти GPU).
+DEEPSCAN_BATCH_SIZE = int(os.getenv("DEEPSCAN_BATCH_SIZE", 8))
+
+# Тип аккумулятора soft voting (3, H, W): float32 — результат бит-в-бит как раньше;
+# float16 — вдвое меньше памяти, но пиксели у порогов 0.1/0.3 и почти-ничьи классов могут сместиться.
+SOFT_VOTING_DTYPE = np.dtype(os.getenv("SOFT_VOTING_DTYPE", "float32"))
+
+# Soft voting и winner-takes-all на GPU (маски YOLO не покидают устройство, на хост копируется
+# одна uint8-карта). Включается явно (1): аккумуляторы 3×H×W делят VRAM с загруженными моделями,
+# при OutOfMemoryError запрос повторяется NumPy-путём. Без CUDA NumPy-путь используется автоматически.
+GPU_POSTPROCESS = int(os.getenv("GPU_POSTPROCESS", 0))
+
+# Тайловый инференс больших сканов: перекрывающиеся тайлы TILE_SIZE×TILE_SIZE в исходном разрешении
+# (imgsz = TILE_SIZE, без даунскейла). TILE_AUTO_MIN_SIDE > 0 — включать автоматически для фото,
+# у которых большая сторона не меньше этого значения; 0 — только по запросу (tiled=true).
+TILE_SIZE = int(os.getenv("TILE_SIZE", 1024))
+TILE_OVERLAP = int(os.getenv("TILE_OVERLAP", 128))
+TILE_AUTO_MIN_SIDE = int(os.getenv("TILE_AUTO_MIN_SIDE", 0))
+# Сколько батчей тайлов одновременно в инференсе. >1 действует только при включённом micro-batching
+# (вызовы одного экземпляра YOLO из разных потоков небезопасны), иначе инференс следующего батча
+# просто идёт параллельно со склейкой предыдущего.
+TILE_WORKERS = int(os.getenv("TILE_WORKERS", 2))
+
+
+# --- ПУЛ ИНФЕРЕНСА ---
+# Тяжёлые вызовы (YOLO, calibrateCamera) выполняются в потоках, а не в event loop:
+# /models и /health отвечают, пока идёт DeepScan. Сверх INFERENCE_QUEUE_DEPTH ожидающих → 429.
+# При INFERENCE_WORKERS > 1 вызовы одной модели сериализуются её замком (SerializedModel):
+# параллельно идут постобработка и запросы к разным моделям.
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 1))
+INFERENCE_QUEUE_DEPTH = int(os.getenv("INFERENCE_QUEUE_DEPTH", 8))
+INFERENCE_RETRY_AFTER_S = int(os.getenv("INFERENCE_RETRY_AFTER_S", 5))
+
+
+class InferencePool:
+    def __init__(self, workers: int, max_queue: int, retry_after: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._admitted = 0   # принятые задачи (в очереди + выполняются)
+        self._in_flight = 0  # выполняются прямо сейчас
+
+    def admit(self):
+        """Занимает место в очереди или отвечает 429. Парный вызов — submit() (или release())."""
+        with self._lock:
+            if self._admitted >= self.workers + self.max_queue:
+                raise HTTPException(
+                    status_code=429,
+                    detail="ML-сервис перегружен, повторите запрос позже",
+                    headers={"Retry-After": str(self.retry_after)},
+                )
+            self._admitted += 1
+
+    async def run(self, fn, *args, **kwargs):
+        self.admit()
+        return await self.submit(fn, *args, **kwargs)
+
+    async def submit(self, fn, *args, **kwargs):
+        """Запуск уже принятой через admit() задачи."""
+        future = self._executor.submit(self._call, fn, *args, **kwargs)
+        # Счётчик освобождается по завершении задачи, даже если клиент уже отключился
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def _call(self, fn, *args, **kwargs):
+        with self._lock:
+            self._in_flight += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._admitted -= 1
+
+    def release(self):
+        """Возврат места, занятого admit(), если задача так и не была отправлена."""
+        self._release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_queue_depth": self.max_queue,
+                "queue_depth": self._admitted - self._in_flight,
+                "in_flight": self._in_flight,
+            }
+
+
+inference_pool = InferencePool(INFERENCE_WORKERS, INFERENCE_QUEUE_DEPTH, INFERENCE_RETRY_AFTER_S)
+
+
+# --- КОНВЕЙЕР ДЕКОДИРОВАНИЯ / КОДИРОВАНИЯ ---
+# imdecode + undistort и imencode + base64 выполняются на CPU-потоках (PIPELINE_CPU_WORKERS), а не в
+# потоке инференса: пока модель занята запросом N, декодируется N+1 и кодируется ответ N-1.
+# PIPELINE_DEPTH — сколько декодированных кадров может ждать модель (кадр 12 МП ≈ 36 МБ).
+PIPELINE_CPU_WORKERS = int(os.getenv("PIPELINE_CPU_WORKERS", 2))
+PIPELINE_DEPTH = int(os.getenv("PIPELINE_DEPTH", 2))
+
+
+class StagedPipeline:
+    STAGES = ("decode", "queue", "inference", "encode")
+
+    def __init__(self, pool: InferencePool, cpu_workers: int, depth: int):
+        self.pool = pool
+        self.depth = depth
+        self._cpu = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix="pipeline-cpu")
+        self._slots = None  # asyncio.Semaphore создаётся в event loop при первом запросе
+        self._lock = threading.Lock()
+        self._totals = {stage: [0, 0.0, 0.0] for stage in self.STAGES}  # count, sum_ms, max_ms
+
+    async def run(self, contents, cam_mtx, d_coeffs, infer, *args, encode=None, **kwargs):
+        """decode (CPU) → infer(img, ...) в пуле инференса → encode(result, payload) (CPU).
+        infer возвращает (result, payload); payload — то, что надо закодировать в ответ."""
+        loop = asyncio.get_running_loop()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.depth)
+        timings = {}
+
+        self.pool.admit()  # 429 до того, как тратить CPU на декодирование
+        slot = [False]
+
+        def free_slot():
+            if slot[0]:
+                slot[0] = False
+                self._slots.release()
+
+        try:
+            await self._slots.acquire()
+            slot[0] = True
+            img = await loop.run_in_executor(self._cpu, self._timed, timings, "decode",
+                                             _decode_image, contents, cam_mtx, d_coeffs)
+        except BaseException:
+            free_slot()
+            self.pool.release()
+            raise
+
+        def run_infer():
+            timings["queue"] = (time.perf_counter() - queued) * 1000.0
+            loop.call_soon_threadsafe(free_slot)  # кадр ушёл в модель — можно декодировать следующий
+            return self._timed(timings, "inference", infer, img, *args, **kwargs)
+
+        queued = time.perf_counter()
+        try:
+            result, payload = await self.pool.submit(run_infer)
+        finally:
+            free_slot()
+        del img  # кадр не держится в памяти, пока кодируется ответ
+
+        if encode is not None:
+            result = await loop.run_in_executor(self._cpu, self._timed, timings, "encode",
+                                                encode, result, payload)
+        self._record(timings)
+        result["timings_ms"] = {stage: round(ms, 1) for stage, ms in timings.items()}
+        return result
+
+    @staticmethod
+    def _timed(timings, stage, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timings[stage] = (time.perf_counter() - start) * 1000.0
+
+    def _record(self, timings):
+        with self._lock:
+            for stage, ms in timings.items():
+                total = self._totals[stage]
+                total[0] += 1
+                total[1] += ms
+                total[2] = max(total[2], ms)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "cpu_workers": self._cpu._max_workers,
+                "depth": self.depth,
+                "stages": {
+                    stage: {"count": n, "avg_ms": round(sum_ms / n, 1) if n else 0.0, "max_ms": round(max_ms, 1)}
+                    for stage, (n, sum_ms, max_ms) in self._totals.items()
+                },
+            }
+
+
+pipeline = StagedPipeline(inference_pool, PIPELINE_CPU_WORKERS, PIPELINE_DEPTH)
+
+
+# --- ПАМЯТЬ ЗАПРОСА ---
+# Пиковый RSS процесса за время запроса (VmHWM из /proc/self/status). Пик сбрасывается через
+# /proc/self/clear_refs, только когда других измеряемых запросов нет: при наложении запросов
+# это пик процесса с начала самого раннего из них (оценка сверху). Вне Linux — ru_maxrss без сброса.
+def _proc_status_mb(field: str) -> Optional[float]:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return round(int(line.split()[1]) / 1024.0, 1)
+    except OSError:
+        pass
+    return None
+
+
+class PeakRssMeter:
+    _lock = threading.Lock()
+    _active = 0
+
+    def __enter__(self):
+        with PeakRssMeter._lock:
+            if PeakRssMeter._active == 0:
+                try:
+                    with open("/proc/self/clear_refs", "w") as f:
+                        f.write("5")
+                except OSError:
+                    pass
+            PeakRssMeter._active += 1
+        self.start_mb = _proc_status_mb("VmRSS")
+        self.peak_mb = None
+        return self
+
+    def __exit__(self, *exc):
+        self.peak_mb = _proc_status_mb("VmHWM")
+        if self.peak_mb is None:
+            import resource
+            self.peak_mb = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+        with PeakRssMeter._lock:
+            PeakRssMeter._active -= 1
+        return False
+
+    def report(self) -> dict:
+        return {"peak_rss_mb": self.peak_mb, "start_rss_mb": self.start_mb}
+
+
+# --- MICRO-BATCHING /predict, /annotate ---
+# Одновременные запросы с одинаковыми (model_name, imgsz, conf, iou, размер фото) за окно
+# MICRO_BATCH_WINDOW_MS склеиваются в один forward pass (до MICRO_BATCH_MAX_SIZE фото).
+# Включается только при INFERENCE_WORKERS > 1: с одним потоком инференса склеивать нечего,
+# а каждый вызов ждал бы окно впустую. MICRO_BATCH_MAX_SIZE=1 отключает батчинг.
+MICRO_BATCH_MAX_SIZE = int(os.getenv("MICRO_BATCH_MAX_SIZE", 8))
+MICRO_BATCH_WINDOW_MS = float(os.getenv("MICRO_BATCH_WINDOW_MS", 5))
+
+
+class _BatchItem:
+    __slots__ = ("key", "model", "images", "kwargs", "done", "results", "error")
+
+    def __init__(self, key, model, images, kwargs):
+        self.key = key
+        self.model = model
+        self.images = images
+        self.kwargs = kwargs
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class MicroBatcher:
+    def __init__(self, max_size: int, window_ms: float):
+        self.max_size = max_size
+        self.window = window_ms / 1000.0
+        self._cond = threading.Condition()
+        self._pending: list[_BatchItem] = []
+        self.batches = 0
+        self.images = 0
+        self._thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, key, model, images, **kwargs):
+        """Блокирует вызывающий поток до готовности результатов своей части батча."""
+        item = _BatchItem(key, model, images, kwargs)
+        with self._cond:
+            self._pending.append(item)
+            self._cond.notify_all()
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.results
+
+    def _take_batch(self) -> list[_BatchItem]:
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            key = self._pending[0].key
+            deadline = time.monotonic() + self.window
+            while True:
+                same = [it for it in self._pending if it.key == key]
+                remaining = deadline - time.monotonic()
+                if sum(len(it.images) for it in same) >= self.max_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, size = [], 0
+            for it in same:
+                if batch and size + len(it.images) > self.max_size:
+                    break
+                batch.append(it)
+                size += len(it.images)
+            for it in batch:
+                self._pending.remove(it)
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._take_batch()
+            images = [img for it in batch for img in it.images]
+            try:
+                with torch.no_grad():
+                    results = batch[0].model(images, verbose=False, **batch[0].kwargs)
+                offset = 0
+                for it in batch:
+                    it.results = results[offset:offset + len(it.images)]
+                    offset += len(it.images)
+                self.batches += 1
+                self.images += len(images)
+            except Exception as e:
+                for it in batch:
+                    it.error = e
+            finally:
+                for it in batch:
+                    it.done.set()
+                del images
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+
+    def stats(self) -> dict:
+        return {
+            "max_batch_size": self.max_size,
+            "window_ms": self.window * 1000.0,
+            "batches": self.batches,
+            "avg_batch_size": round(self.images / self.batches, 2) if self.batches else 0.0,
+        }
+
+
+class BatchedModel:
+    """Подменяет YOLO в analyze_biomass: вызов модели уходит в общий MicroBatcher,
+    обратно возвращаются только результаты своих изображений."""
+
+    def __init__(self, batcher: MicroBatcher, model_name: str, model: SerializedModel):
+        self.batcher = batcher
+        self.model_name = model_name
+        self.model = model
+
+    def __call__(self, images, conf, iou, imgsz, verbose=False):
+        if not isinstance(images, list):
+            images = [images]
+        # Размер фото входит в ключ: letterbox батча остаётся таким же, как у одиночного вызова.
+        # id экземпляра — тоже: после перезагрузки чекпойнта (scan) старый и новый экземпляр
+        # под одним именем не должны попасть в один forward pass
+        key = (self.model_name, id(self.model), imgsz, conf, iou, images[0].shape)
+        return self.batcher.submit(key, self.model, images, conf=conf, iou=iou, imgsz=imgsz)
+
+
+micro_batcher = (MicroBatcher(MICRO_BATCH_MAX_SIZE, MICRO_BATCH_WINDOW_MS)
+                 if MICRO_BATCH_MAX_SIZE > 1 and INFERENCE_WORKERS > 1 else None)
+
+
+# --- КЭШ РЕЗУЛЬТАТОВ ---
+# Ключ = sha256(байты фото + параметры анализа). Повторная отправка того же фото с теми же
+# настройками (ретраи бота, повторный клик «разметить») отдаётся без инференса.
+# Уровни: LRU в памяти (RESULT_CACHE_MEMORY_MB) + опционально диск (RESULT_CACHE_DIR, RESULT_CACHE_DISK_MB).
+RESULT_CACHE_MEMORY_MB = float(os.getenv("RESULT_CACHE_MEMORY_MB", 256))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_MB = float(os.getenv("RESULT_CACHE_DISK_MB", 2048))
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class ResultCache:
+    def __init__(self, memory_mb: float, disk_dir: str, disk_mb: float, suffix: str = ".json.z"):
+        self.suffix = suffix
+        self.memory_budget = int(memory_mb * 1024 * 1024)
+        self.disk_dir = disk_dir or None
+        self.disk_budget = int(disk_mb * 1024 * 1024)
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.disk_dir and os.path.isdir(self.disk_dir):
+            self._disk_bytes = sum(e.stat().st_size for e in os.scandir(self.disk_dir)
+                                   if e.is_file() and e.name.endswith(self.suffix))
+
+    @staticmethod
+    def make_key(contents: bytes, **params) -> str:
+        digest = hashlib.sha256(contents)
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}{self.suffix}")
+
+    def get(self, key: str) -> Optional[dict]:
+        blob = self.get_blob(key)
+        return json.loads(zlib.decompress(blob)) if blob is not None else None
+
+    def put(self, key: str, value: dict):
+        self.put_blob(key, zlib.compress(json.dumps(value, default=_json_default).encode("utf-8"), 1))
+
+    def get_blob(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            blob = self._memory.get(key)
+            if blob is not None:
+                self._memory.move_to_end(key)
+
+        if blob is None and self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path, "rb") as f:
+                    blob = f.read()
+                os.utime(path)  # mtime = время последнего обращения (LRU на диске)
+                self._put_memory(key, blob)
+            except FileNotFoundError:
+                blob = None
+
+        with self._lock:
+            if blob is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return blob
+
+    def put_blob(self, key: str, blob: bytes):
+        self._put_memory(key, blob)
+        if self.disk_dir:
+            # Папка создаётся при первой записи, а не при импорте модуля
+            os.makedirs(self.disk_dir, exist_ok=True)
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(blob)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._disk_bytes += len(blob)
+                over_budget = self._disk_bytes > self.disk_budget
+            if over_budget:
+                self._evict_disk()
+
+    def _put_memory(self, key: str, blob: bytes):
+        if len(blob) > self.memory_budget:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old)
+            self._memory[key] = blob
+            self._memory_bytes += len(blob)
+            while self._memory_bytes > self.memory_budget:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _evict_disk(self):
+        """Удаляет самые давно использованные файлы, пока кэш не уложится в 90% бюджета."""
+        entries = []
+        for e in os.scandir(self.disk_dir):
+            if e.is_file() and e.name.endswith(self.suffix):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+        total = sum(size for _, size, _ in entries)
+        target = int(self.disk_budget * 0.9)
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "memory_mb": round(self._memory_bytes / 1024 / 1024, 1),
+                "disk_mb": round(self._disk_bytes / 1024 / 1024, 1) if self.disk_dir else None,
+            }
+
+
+result_cache = ResultCache(RESULT_CACHE_MEMORY_MB, RESULT_CACHE_DIR, RESULT_CACHE_DISK_MB)
+
+# Финальные маски (PNG с битовыми плоскостями) после /annotate: /render перекрашивает
+# overlay по ним без YOLO. Ключ — тот же хэш фото + параметров анализа, но без палитры.
+# Относительный путь считается от папки сервиса, а не от текущей директории процесса
+# (пусто = только память)
+MASK_STORE_DIR = os.getenv("MASK_STORE_DIR", "mask_store")
+if MASK_STORE_DIR:
+    MASK_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), MASK_STORE_DIR)
+MASK_STORE_MEMORY_MB = float(os.getenv("MASK_STORE_MEMORY_MB", 64))
+MASK_STORE_DISK_MB = float(os.getenv("MASK_STORE_DISK_MB", 1024))
+mask_store = ResultCache(MASK_STORE_MEMORY_MB, MASK_STORE_DIR, MASK_STORE_DISK_MB, suffix=".png")
+
 
 # Калибровка камеры теперь персональная (через /calibrate endpoint).
 # Глобальные CAMERA_MATRIX / DIST_COEFFS удалены — undistort применяется
 # только если пользователь прошёл калибровку.
 
+# --- КАРТЫ UNDISTORT ---
+# cv2.undistort на каждом фото заново строит сетку remap. Карты initUndistortRectifyMap считаются
+# один раз на (camera matrix, dist coeffs, размер фото) и живут в LRU (UNDISTORT_CACHE_MB).
+# Формат — фиксированная точка CV_16SC2 + CV_16UC1 (6 байт/пиксель, как внутри cv2.undistort),
+# поэтому cv2.remap даёт тот же результат.
+UNDISTORT_CACHE_MB = float(os.getenv("UNDISTORT_CACHE_MB", 256))
+
+
+class UndistortMaps:
+    def __init__(self, memory_mb: float):
+        self.budget = int(memory_mb * 1024 * 1024)
+        self._maps: OrderedDict[str, tuple] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def profile_key(cam_mtx, d_coeffs) -> str:
+        """Хэш калибровки — он же calibration_id профиля."""
+        digest = hashlib.sha256()
+        for arr in (cam_mtx, d_coeffs):
+            digest.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        return digest.hexdigest()[:16]
+
+    def get(self, cam_mtx, d_coeffs, size):
+        """(map1, map2) для cv2.remap; size = (w, h)."""
+        key = f"{self.profile_key(cam_mtx, d_coeffs)}:{size[0]}x{size[1]}"
+        with self._lock:
+            maps = self._maps.get(key)
+            if maps is not None:
+                self._maps.move_to_end(key)
+                self.hits += 1
+                return maps
+            self.misses += 1
+
+        cam = np.asarray(cam_mtx, dtype=np.float64)
+        maps = cv2.initUndistortRectifyMap(cam, np.asarray(d_coeffs, dtype=np.float64), None, cam,
+                                           tuple(size), cv2.CV_16SC2)
+        nbytes = maps[0].nbytes + maps[1].nbytes
+        if nbytes <= self.budget:
+            with self._lock:
+                if key not in self._maps:
+                    self._maps[key] = maps
+                    self._bytes += nbytes
+                while self._bytes > self.budget:
+                    _, (m1, m2) = self._maps.popitem(last=False)
+                    self._bytes -= m1.nbytes + m2.nbytes
+        return maps
+
+    def undistort(self, img, cam_mtx, d_coeffs):
+        """Эквивалент cv2.undistort(img, cam_mtx, d_coeffs, None, cam_mtx) по кэшированным картам."""
+        h, w = img.shape[:2]
+        map1, map2 = self.get(cam_mtx, d_coeffs, (w, h))
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._maps),
+                "memory_mb": round(self._bytes / 1024 / 1024, 1),
+            }
+
+
+undistort_maps = UndistortMaps(UNDISTORT_CACHE_MB)
+
+
+# --- ПРОФИЛИ КАЛИБРОВКИ ---
+# /calibrate регистрирует профиль (camera matrix + dist coeffs) и возвращает calibration_id;
+# /predict, /annotate, /render принимают calibration_id вместо JSON-матриц. id — хэш калибровки,
+# повторная регистрация даёт тот же id. Неизвестный id → 409 (бэкенд регистрирует профиль заново).
+CALIB_PROFILES_FILE = os.getenv("CALIB_PROFILES_FILE", "calib_profiles.json")
+
+
+class CalibrationProfiles:
+    def __init__(self, path: str, maps: UndistortMaps):
+        self.path = path or None
+        self.maps = maps
+        self._lock = threading.Lock()
+        self._raw = self._load()  # id → {"camera_matrix", "dist_coeffs", "image_size"} (как в файле)
+        self._profiles = {
+            profile_id: (np.asarray(p["camera_matrix"], dtype=np.float64), np.asarray(p["dist_coeffs"], dtype=np.float64))
+            for profile_id, p in self._raw.items()
+        }
+
+    def _load(self) -> dict:
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._raw, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ Не удалось сохранить профили калибровки {self.path}: {e}")
+
+    def register(self, camera_matrix, dist_coeffs, image_size=None) -> str:
+        cam_mtx = np.asarray(camera_matrix, dtype=np.float64)
+        d_coeffs = np.asarray(dist_coeffs, dtype=np.float64)
+        profile_id = self.maps.profile_key(cam_mtx, d_coeffs)
+        with self._lock:
+            if profile_id not in self._profiles:
+                self._profiles[profile_id] = (cam_mtx, d_coeffs)
+                self._raw[profile_id] = {
+                    "camera_matrix": cam_mtx.tolist(), "dist_coeffs": d_coeffs.tolist(),
+                    "image_size": list(image_size) if image_size else None,
+                }
+                self._save()
+        # Фото с той же камеры обычно того же размера, что и снимки доски — карты строятся заранее
+        if image_size:
+            threading.Thread(target=self.maps.get, args=(cam_mtx, d_coeffs, tuple(image_size)),
+                             name="undistort-warmup", daemon=True).start()
+        return profile_id
+
+    def get(self, profile_id: str):
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"profiles": len(self._profiles)}
+
+
+calibration_profiles = CalibrationProfiles(CALIB_PROFILES_FILE, undistort_maps)
+
 
 def box_counting_dimension(binary_img):
     """Фрактальная размерность через box-counting (Tatsumi 1989, Nielsen 1997).
@@ -120,14 +1219,17 @@ def box_counting_dimension(binary_img):
     sizes = [2, 4, 8, 16, 32, 64, 128]
     counts = []
     valid_sizes = []
+    # Занятость боксов size×size (сетка от (0,0), неполные боксы на краях считаются).
+    # Размеры — степени двойки, поэтому каждый уровень = OR-пулинг 2×2 предыдущего.
+    occupied = cropped != 0
     for size in sizes:
         if size > min(cropped.shape):
             break
-        count = 0
-        for i in range(0, cropped.shape[0], size):
-            for j in range(0, cropped.shape[1], size):
-                if np.any(cropped[i:i + size, j:j + size]):
-                    count += 1
+        pad_h, pad_w = occupied.shape[0] % 2, occupied.shape[1] % 2
+        if pad_h or pad_w:
+            occupied = np.pad(occupied, ((0, pad_h), (0, pad_w)))
+        occupied = occupied.reshape(occupied.shape[0] // 2, 2, occupied.shape[1] // 2, 2).any(axis=(1, 3))
+        count = int(np.count_nonzero(occupied))
         if count > 0:
             counts.append(count)
             valid_sizes.append(size)
@@ -150,9 +1252,247 @@ def get_polygons_from_mask(mask, offset_id=0):
     return polygons, count
 
 
+# --- КОМПАКТНАЯ ГЕОМЕТРИЯ ---
+# path [[x, y], ...] → "path_enc": base64(zigzag-varint дельт x0, y0, dx1, dy1, ...).
+# Первая точка абсолютная, далее смещения от предыдущей. Декодеры: backend api/services/geometry.py,
+# frontend src/services/geometry.js.
+def encode_path(points) -> str:
+    flat = np.asarray(points, dtype=np.int64).reshape(-1)
+    if flat.size == 0:
+        return ""
+    deltas = flat.copy()
+    deltas[2:] = flat[2:] - flat[:-2]
+    zigzag = (deltas << 1) ^ (deltas >> 63)
+    n_bytes = np.ones(zigzag.shape, dtype=np.int64)
+    for shift in (7, 14, 21, 28, 35):
+        n_bytes += zigzag >= (1 << shift)
+    starts = np.cumsum(n_bytes) - n_bytes
+    out = np.empty(int(n_bytes.sum()), dtype=np.uint8)
+    for k in range(int(n_bytes.max())):
+        sel = n_bytes > k
+        chunk = (zigzag[sel] >> (7 * k)) & 0x7F
+        more = (n_bytes[sel] > k + 1).astype(np.int64) << 7
+        out[starts[sel] + k] = chunk | more
+    return base64.b64encode(out.tobytes()).decode("ascii")
+
+
+def compact_geometry(items, closed, simplify_px=0.0):
+    """Заменяет path на path_enc; при simplify_px > 0 — упрощение Douglas-Peucker (approxPolyDP)."""
+    result = []
+    for item in items:
+        points = np.asarray(item["path"], dtype=np.int32).reshape(-1, 1, 2)
+        if simplify_px > 0 and len(points) > 2:
+            points = cv2.approxPolyDP(points, simplify_px, closed)
+        compact = {k: v for k, v in item.items() if k != "path"}
+        compact["path_enc"] = encode_path(points)
+        result.append(compact)
+    return result
+
+
+def format_geometry(result: dict, geometry_format: str, simplify_px: float = 0.0) -> dict:
+    if geometry_format != "compact":
+        return result
+    result["segments"] = compact_geometry(result.get("segments", []), closed=False, simplify_px=simplify_px)
+    result["leaves"] = compact_geometry(result.get("leaves", []), closed=True, simplify_px=simplify_px)
+    result["stems"] = compact_geometry(result.get("stems", []), closed=True, simplify_px=simplify_px)
+    result["geometry_format"] = "compact"
+    return result
+
+
+def class_max_maps(res):
+    """Мягкие карты классов одного прохода YOLO на разрешении масок: (cls_id, max по экземплярам
+    класса от mask_prob * conf). Максимум берётся одной редукцией на класс, до размера кадра
+    растягивается только итоговая карта."""
+    if res.masks is None:
+        return
+
+    classes = res.boxes.cls.cpu().numpy().astype(np.int64)
+    conf_scores = res.boxes.conf.cpu().numpy().astype(np.float32)
+    masks_data = res.masks.data.cpu().numpy()
+
+    # Мягкая маска (0..1) * уверенность детектора → weighted score. Копируются и масштабируются
+    # только экземпляры своего класса: за все классы суммарно один проход по N×H×W
+    for cls_id in range(3):
+        idx = np.flatnonzero(classes == cls_id)
+        if idx.size == 0:
+            continue
+        weighted = masks_data[idx].astype(np.float32, copy=False)
+        weighted *= conf_scores[idx, None, None]
+        yield cls_id, weighted.max(axis=0)
+
+
+def accumulate_class_masks(res, scores, votes, vote_region=None, window=None):
+    """Добавляет проход YOLO к аккумуляторам на месте: scores (3, H, W) — сумма score,
+    votes (3, H, W) uint8 — число проходов со score > 0.05. Промежуточная карта — одна (H, W) на класс.
+    window — вес склейки тайла; vote_region — (slice_y, slice_x) части тайла, где он считает голоса."""
+    h, w = scores.shape[1:]
+    for cls_id, class_max in class_max_maps(res):
+        fused = cv2.resize(class_max, (w, h), interpolation=cv2.INTER_LINEAR)
+        if vote_region is None:
+            votes[cls_id] += fused > 0.05
+        else:
+            votes[cls_id][vote_region] += fused[vote_region] > 0.05
+        if window is not None:
+            fused *= window
+        scores[cls_id] += fused
+
+
+def winner_takes_all(scores, votes, min_score, min_votes=None):
+    """Разрешение конфликтов классов по аккумуляторам soft voting.
+    Возвращает (winner uint8 — класс с максимальным суммарным score, background — пиксели, где ни
+    один класс не набрал min_score, strong — победивший класс найден в ≥ min_votes проходах или None).
+    argmax через попарные сравнения: winner сразу uint8, без int64-карты; строгое > сохраняет
+    правило np.argmax (при равенстве побеждает меньший индекс)."""
+    score_leaf, score_root, score_stem = scores
+    winner = (score_root > score_leaf).astype(np.uint8)
+    max_score = np.maximum(score_leaf, score_root)
+    winner[score_stem > max_score] = 2
+    np.maximum(max_score, score_stem, out=max_score)
+    background = max_score < min_score
+
+    strong = None
+    if min_votes is not None:
+        strong = np.zeros(winner.shape, dtype=bool)
+        for cls_id in range(3):
+            strong |= (winner == cls_id) & (votes[cls_id] >= min_votes)
+    return winner, background, strong
+
+
+def soft_vote_torch(yolo_model, images, conf, iou, imgsz, batch_size, h, w, min_score, min_votes=None,
+                    device=None):
+    """GPU-вариант прогона + soft voting + winner_takes_all: маски, апсемплинг, max по классам,
+    аккумуляторы и argmax остаются на устройстве. На хост уходит одна uint8-карта
+    (биты 0-1 — winner, 2 — background, 3 — strong). Результат тот же, что у NumPy-пути,
+    с точностью до округления билинейной интерполяции."""
+    device = device or torch.device("cuda")
+    scores = torch.zeros((3, h, w), dtype=getattr(torch, SOFT_VOTING_DTYPE.name), device=device)
+    votes = torch.zeros((3, h, w), dtype=torch.uint8, device=device)
+
+    with torch.no_grad():
+        for start in range(0, len(images), batch_size):
+            results = yolo_model(images[start:start + batch_size], conf=conf, iou=iou, imgsz=imgsz, verbose=False)
+            for res in results:
+                if res.masks is None:
+                    continue
+                classes = res.boxes.cls.to(device).long()
+                known = classes < 3
+                # Мягкая маска (0..1) * уверенность детектора → weighted score, max по экземплярам класса
+                weighted = res.masks.data.to(device, torch.float32)[known] \
+                    * res.boxes.conf.to(device, torch.float32)[known][:, None, None]
+                fused = torch.zeros((3,) + tuple(weighted.shape[1:]), dtype=torch.float32, device=device)
+                index = classes[known][:, None, None].expand_as(weighted)
+                fused.scatter_reduce_(0, index, weighted, "amax", include_self=True)
+                fused = torch.nn.functional.interpolate(fused[None], size=(h, w), mode="bilinear",
+                                                        align_corners=False)[0]
+                votes += fused > 0.05
+                scores += fused
+                del fused, weighted
+            del results
+
+        score_leaf, score_root, score_stem = scores
+        winner = (score_root > score_leaf).to(torch.uint8)
+        max_score = torch.maximum(score_leaf, score_root)
+        winner[score_stem > max_score] = 2
+        torch.maximum(max_score, score_stem, out=max_score)
+        packed = winner | ((max_score < min_score).to(torch.uint8) << 2)
+        if min_votes is not None:
+            strong = votes.gather(0, winner.long()[None])[0] >= min_votes
+            packed |= strong.to(torch.uint8) << 3
+        packed = packed.cpu().numpy()
+
+    del scores, votes, score_leaf, score_root, score_stem, winner, max_score
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return packed & 3, (packed & 4) != 0, ((packed & 8) != 0) if min_votes is not None else None
+
+
+def tile_starts(length, tile, overlap):
+    """Начала тайлов вдоль оси: шаг tile - overlap, последний тайл прижат к краю."""
+    if length <= tile:
+        return [0]
+    step = max(1, tile - overlap)
+    starts = list(range(0, length - tile + 1, step))
+    if starts[-1] != length - tile:
+        starts.append(length - tile)
+    return starts
+
+
+def tile_ramp(n, overlap):
+    """Вес склейки вдоль оси тайла: линейный спад к краям на ширине overlap. Вес везде > 0,
+    поэтому после нормировки на сумму весов пиксели у краев изображения не теряются."""
+    if overlap <= 0:
+        return np.ones(n, dtype=np.float32)
+    pos = np.arange(n, dtype=np.float32) + 0.5
+    return np.minimum(1.0, np.minimum(pos, n - pos) / overlap).astype(np.float32)
+
+
+def tile_vote_bounds(starts, tile, length):
+    """Делит ось на непересекающиеся отрезки по тайлам (граница — середина перекрытия соседей):
+    голос пикселя берётся из тайла, где он дальше всего от края."""
+    bounds = [0]
+    for prev, nxt in zip(starts, starts[1:]):
+        bounds.append((nxt + prev + tile) // 2)
+    bounds.append(length)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def tiled_class_scores(yolo_model, images, conf, iou, tile, overlap, batch_size, scores, votes):
+    """Soft voting по тайлам: все TTA-варианты режутся на перекрывающиеся тайлы, тайлы идут в YOLO
+    батчами с imgsz = tile, мягкие карты классов склеиваются с весами окна тайла.
+    Заполняет scores/votes так же, как полнокадровый проход: scores — сумма по проходам склеенных
+    score, votes — число проходов со score > 0.05 (из тайла, где пиксель ближе всего к центру)."""
+    h, w = images[0].shape[:2]
+    th, tw = min(tile, h), min(tile, w)
+    ramp_y, ramp_x = tile_ramp(th, overlap), tile_ramp(tw, overlap)
+    window = np.outer(ramp_y, ramp_x)
+    ys, xs = tile_starts(h, th, overlap), tile_starts(w, tw, overlap)
+    boxes = [(y, x, (slice(vy0 - y, vy1 - y), slice(vx0 - x, vx1 - x)))
+             for y, (vy0, vy1) in zip(ys, tile_vote_bounds(ys, th, h))
+             for x, (vx0, vx1) in zip(xs, tile_vote_bounds(xs, tw, w))]
+
+    # Окно сепарабельно, поэтому сумма весов по сетке тайлов — outer двух векторов, а не карта (H, W)
+    weight_y = np.zeros(h, dtype=np.float32)
+    weight_x = np.zeros(w, dtype=np.float32)
+    for y in ys:
+        weight_y[y:y + th] += ramp_y
+    for x in xs:
+        weight_x[x:x + tw] += ramp_x
+
+    jobs = [(img, box) for img in images for box in boxes]
+    batches = [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+
+    def infer(batch):
+        crops = [np.ascontiguousarray(img[y:y + th, x:x + tw]) for img, (y, x, _) in batch]
+        with torch.no_grad():
+            return yolo_model(crops, conf=conf, iou=iou, imgsz=tile, verbose=False)
+
+    def stitch(batch, results):
+        for (_, (y, x, vote_region)), res in zip(batch, results):
+            accumulate_class_masks(res, scores[:, y:y + th, x:x + tw], votes[:, y:y + th, x:x + tw],
+                                   vote_region=vote_region, window=window)
+
+    # В полёте не больше workers + 1 батчей: память ограничена размером тайла, а не фото
+    workers = max(1, TILE_WORKERS) if isinstance(yolo_model, BatchedModel) else 1
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tiles") as executor:
+        pending = []
+        for batch in batches:
+            pending.append((batch, executor.submit(infer, batch)))
+            if len(pending) > workers:
+                done_batch, future = pending.pop(0)
+                stitch(done_batch, future.result())
+        for done_batch, future in pending:
+            stitch(done_batch, future.result())
+
+    scores /= weight_y[None, :, None]
+    scores /= weight_x[None, None, :]
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
 def analyze_biomass(yolo_model, img, conf, iou, imgsz, draw_annotation=False, deep_scan=False,
                     mm_per_pixel=None, cm2_per_pixel=None,
-                    bake_overlay=False, color_leaf='#16A34A', color_root='#9333EA', color_stem='#2563EB'):
+                    bake_overlay=False, color_leaf='#16A34A', color_root='#9333EA', color_stem='#2563EB',
+                    tta_batch_size=None, masks_out=None, tile_size=None):
     mm_per_pixel = mm_per_pixel or MM_PER_PIXEL
     # Всегда выводим cm2_per_pixel из mm_per_pixel, если не передан явно
     cm2_per_pixel = cm2_per_pixel or (mm_per_pixel / 10.0) ** 2
@@ -178,6 +1518,12 @@ def analyze_biomass(yolo_model, img, conf, iou, imgsz, draw_annotation=False, de
         "specific_root_length": 0.0
     }
 
+    # tile_size: None — по TILE_AUTO_MIN_SIDE, 0 — полный кадр, > 0 — тайлы этого размера
+    if tile_size is None:
+        tile_size = TILE_SIZE if TILE_AUTO_MIN_SIDE > 0 and max(h, w) >= TILE_AUTO_MIN_SIDE else 0
+    tiled = tile_size > 0 and max(h, w) > tile_size
+    metrics["is_tiled"] = tiled
+
     # === 1. ГЕНЕРАЦИЯ АУГМЕНТАЦИЙ (TTA) ===
     # Только фотометрические — пиксели остаются на местах, flip убран (вызывал артефакты)
     images_to_process = [img]
@@ -207,72 +1553,58 @@ def analyze_biomass(yolo_model, img, conf, iou, imgsz, draw_annotation=False, de
             cv2.convertScaleAbs(img, alpha=1.2, beta=-10),   # контраст+ с затемнением
         ])
 
-    # Мягкие аккумуляторы (float): каждый пиксель копит weighted score
-    acc_leaf = np.zeros((h, w), dtype=np.float32)
-    acc_root = np.zeros((h, w), dtype=np.float32)
-    acc_stem = np.zeros((h, w), dtype=np.float32)
-
-    # Счётчики голосов: сколько проходов обнаружили пиксель (для edge recovery)
-    vote_leaf = np.zeros((h, w), dtype=np.int32)
-    vote_root = np.zeros((h, w), dtype=np.int32)
-    vote_stem = np.zeros((h, w), dtype=np.int32)
-
-    # === 2. ПРОГОН НЕЙРОСЕТИ И SOFT VOTING ===
-    for aug_img in images_to_process:
-        with torch.no_grad():
-            res = yolo_model(aug_img, conf=conf, iou=iou, imgsz=imgsz, verbose=False)[0]
-
-        # Мягкие маски текущей аугментации (max по экземплярам одного класса)
-        aug_leaf = np.zeros((h, w), dtype=np.float32)
-        aug_root = np.zeros((h, w), dtype=np.float32)
-        aug_stem = np.zeros((h, w), dtype=np.float32)
-
-        if res.masks is not None:
-            classes = res.boxes.cls.cpu().numpy()
-            conf_scores = res.boxes.conf.cpu().numpy()
-            masks_data = res.masks.data.cpu().numpy()
-
-            for j in range(len(masks_data)):
-                cls_id = int(classes[j])
-                conf_j = float(conf_scores[j])
-                # Мягкая маска (0..1) * уверенность детектора → weighted score
-                soft_mask = cv2.resize(masks_data[j], (w, h), interpolation=cv2.INTER_LINEAR)
-                weighted = soft_mask * conf_j
-
-                if cls_id == 0:
-                    aug_leaf = np.maximum(aug_leaf, weighted)
-                elif cls_id == 1:
-                    aug_root = np.maximum(aug_root, weighted)
-                elif cls_id == 2:
-                    aug_stem = np.maximum(aug_stem, weighted)
-
-        # Суммируем голоса всех аугментаций
-        acc_leaf += aug_leaf
-        acc_root += aug_root
-        acc_stem += aug_stem
-
-        # Считаем в скольких проходах пиксель был обнаружён (порог 0.05 на проход)
-        vote_leaf += (aug_leaf > 0.05).astype(np.int32)
-        vote_root += (aug_root > 0.05).astype(np.int32)
-        vote_stem += (aug_stem > 0.05).astype(np.int32)
-
-        del res
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-
     # === 3. WINNER-TAKES-ALL (разрешение конфликтов классов) ===
-    # Стек: (3, H, W) — суммарный score по каждому классу
-    class_scores = np.stack([acc_leaf, acc_root, acc_stem], axis=0)
-    max_score = np.max(class_scores, axis=0)
-
     # Порог: отсекаем фон (пиксели где ни один класс не набрал достаточно)
     # Express: 1 прогон, score = mask_prob * conf (0..1), порог 0.1
     # DeepScan: 8 прогонов, score суммируется, порог 0.3
     min_score = 0.3 if deep_scan else 0.1
-    background = max_score < min_score
+    # Edge recovery (DeepScan): пиксели, где победивший класс найден в ≥2 проходах
+    min_votes = 2 if deep_scan else None
 
-    # Побеждает класс с максимальным суммарным весом — overlap невозможен
-    winner = np.argmax(class_scores, axis=0)
+    batch_size = max(1, int(tta_batch_size or DEEPSCAN_BATCH_SIZE))
+    gpu_result = None
+    if GPU_POSTPROCESS and not tiled and torch.cuda.is_available():
+        # === 2. ПРОГОН НЕЙРОСЕТИ И SOFT VOTING НА GPU (+ winner-takes-all там же) ===
+        try:
+            gpu_result = soft_vote_torch(
+                yolo_model, images_to_process, conf, iou, imgsz, batch_size, h, w, min_score, min_votes)
+        except torch.cuda.OutOfMemoryError:
+            # Аккумуляторы в полном разрешении не поместились рядом с моделями — повтор на CPU
+            torch.cuda.empty_cache()
+            print(f"⚠️ Не хватило памяти GPU для постобработки {w}x{h}, повтор на CPU (NumPy)")
+    if gpu_result is not None:
+        winner, background, strong_votes = gpu_result
+    else:
+        # Компактные аккумуляторы, обновляются на месте: один тензор суммарного score классов
+        # (SOFT_VOTING_DTYPE) и счётчики голосов в uint8 (для edge recovery, проходов не больше 8)
+        class_scores = np.zeros((3, h, w), dtype=SOFT_VOTING_DTYPE)
+        votes = np.zeros((3, h, w), dtype=np.uint8)
+
+        if tiled:
+            # === 2*. ТАЙЛОВЫЙ ПРОГОН: перекрывающиеся тайлы в исходном разрешении, склейка с весами ===
+            tiled_class_scores(yolo_model, images_to_process, conf, iou, tile_size, TILE_OVERLAP, batch_size,
+                               class_scores, votes)
+        else:
+            # === 2. ПРОГОН НЕЙРОСЕТИ И SOFT VOTING ===
+            # Аугментации идут в сеть батчами: один forward pass вместо 8 отдельных вызовов
+            for start in range(0, len(images_to_process), batch_size):
+                with torch.no_grad():
+                    results = yolo_model(images_to_process[start:start + batch_size],
+                                         conf=conf, iou=iou, imgsz=imgsz, verbose=False)
+
+                for res in results:
+                    # Мягкие маски аугментации (max по экземплярам класса) суммируются в class_scores,
+                    # проходы со score > 0.05 считаются в votes
+                    accumulate_class_masks(res, class_scores, votes)
+
+                del results
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+
+        winner, background, strong_votes = winner_takes_all(class_scores, votes, min_score, min_votes)
+        del class_scores, votes
+    # TTA-копии кадра больше не нужны — не держим их на время скелетизации
+    del images_to_process
 
     leaf_mask = ((winner == 0) & ~background).astype(np.uint8)
     root_mask = ((winner == 1) & ~background).astype(np.uint8)
@@ -289,10 +1621,9 @@ def analyze_biomass(yolo_model, img, conf, iou, imgsz, draw_annotation=False, de
     # Восстанавливаем краевые пиксели, обнаруженные в ≥2 проходах,
     # если winner-takes-all относит их к тому же классу.
     if deep_scan:
-        min_votes = 2
-        leaf_mask = np.maximum(leaf_mask, ((winner == 0) & (vote_leaf >= min_votes)).astype(np.uint8))
-        root_mask = np.maximum(root_mask, ((winner == 1) & (vote_root >= min_votes)).astype(np.uint8))
-        stem_mask = np.maximum(stem_mask, ((winner == 2) & (vote_stem >= min_votes)).astype(np.uint8))
+        leaf_mask = np.maximum(leaf_mask, ((winner == 0) & strong_votes).astype(np.uint8))
+        root_mask = np.maximum(root_mask, ((winner == 1) & strong_votes).astype(np.uint8))
+        stem_mask = np.maximum(stem_mask, ((winner == 2) & strong_votes).astype(np.uint8))
         # Повторная очистка после восстановления
         leaf_mask = cv2.morphologyEx(leaf_mask, cv2.MORPH_CLOSE, kernel_close)
         root_mask = cv2.morphologyEx(root_mask, cv2.MORPH_CLOSE, kernel_close)
@@ -394,34 +1725,38 @@ def analyze_biomass(yolo_model, img, conf, iou, imgsz, draw_annotation=False, de
             kernel_stem = np.ones((5, 5), np.uint8)
             stem_dilated = cv2.dilate(stem_mask, kernel_stem, iterations=1)
 
+            # Имена колонок summarize() отличаются между версиями skan ('-' или '_')
+            def column(name):
+                return branch_data[name if name in branch_data.columns else name.replace('-', '_')].to_numpy()
+
+            branch_ids = branch_data.index.to_numpy()
+            b_dist = column('branch-distance').astype(np.float64)
+            b_type = column('branch-type')
+            src_ids = column('node-id-src').astype(np.int64)
+            dst_ids = column('node-id-dst').astype(np.int64)
+            src_coords = np.stack([column('image-coord-src-0'), column('image-coord-src-1')], axis=1).astype(int)
+            dst_coords = np.stack([column('image-coord-dst-0'), column('image-coord-dst-1')], axis=1).astype(int)
+
+            # Отсекаем короткие концевые ветви (шум скелетизации)
+            dist_mm_all = b_dist * mm_per_pixel
+            valid = np.flatnonzero(~((b_type == 1) & (dist_mm_all < MIN_ROOT_LENGTH_MM)))
+            valid_branch_indices = branch_ids[valid]
+
             G = nx.Graph()
-            node_to_coords = {}
-            anchor_nodes = set()
-            valid_branch_indices = []
-
-            for index, row in branch_data.iterrows():
-                b_dist = row.get('branch-distance') if 'branch-distance' in row else row.get('branch_distance')
-                b_type = row.get('branch-type') if 'branch-type' in row else row.get('branch_type')
-                dist_mm = b_dist * mm_per_pixel
-                if b_type == 1 and dist_mm < MIN_ROOT_LENGTH_MM: continue
-
-                valid_branch_indices.append(index)
-                u = int(row.get('node-id-src') if 'node-id-src' in row else row.get('node_id_src'))
-                v = int(row.get('node-id-dst') if 'node-id-dst' in row else row.get('node_id_dst'))
-                G.add_edge(u, v, weight=dist_mm, index=index)
-
-                c_src_y = row.get('image-coord-src-0') if 'image-coord-src-0' in row else row.get('image_coord_src_0')
-                c_src_x = row.get('image-coord-src-1') if 'image-coord-src-1' in row else row.get('image_coord_src_1')
-                c_dst_y = row.get('image-coord-dst-0') if 'image-coord-dst-0' in row else row.get('image_coord_dst_0')
-                c_dst_x = row.get('image-coord-dst-1') if 'image-coord-dst-1' in row else row.get('image_coord_dst_1')
-
-                node_to_coords[u] = (int(c_src_y), int(c_src_x))
-                node_to_coords[v] = (int(c_dst_y), int(c_dst_x))
-
-            for node_id, (coord_y, coord_x) in node_to_coords.items():
-                if 0 <= coord_y < h and 0 <= coord_x < w:
-                    if stem_dilated[coord_y, coord_x] > 0:
-                        anchor_nodes.add(node_id)
+            G.add_edges_from(
+                (int(u), int(v), {"weight": d, "index": idx})
+                for u, v, d, idx in zip(src_ids[valid], dst_ids[valid], dist_mm_all[valid], valid_branch_indices)
+            )
+
+            # Узел → (y, x): src и dst каждой ветви по порядку, как в таблице skan
+            node_ids = np.stack([src_ids[valid], dst_ids[valid]], axis=1).ravel()
+            node_yx = np.stack([src_coords[valid], dst_coords[valid]], axis=1).reshape(-1, 2)
+            node_to_coords = dict(zip(node_ids.tolist(), map(tuple, node_yx.tolist())))
+
+            in_bounds = (node_yx[:, 0] >= 0) & (node_yx[:, 0] < h) & (node_yx[:, 1] >= 0) & (node_yx[:, 1] < w)
+            on_stem = np.zeros(len(node_ids), dtype=bool)
+            on_stem[in_bounds] = stem_dilated[node_yx[in_bounds, 0], node_yx[in_bounds, 1]] > 0
+            anchor_nodes = set(node_ids[on_stem].tolist())
 
             roots_attached_to_stems = 0
             primary_edges = set()
@@ -447,55 +1782,68 @@ def analyze_biomass(yolo_model, img, conf, iou, imgsz, draw_annotation=False, de
 
             metrics["root_anchors"] = roots_attached_to_stems
 
-            for index in valid_branch_indices:
-                row = branch_data.loc[index]
-                b_dist = row.get('branch-distance') if 'branch-distance' in row else row.get('branch_distance')
-                dist_mm = b_dist * mm_per_pixel
-                coords = skeleton_obj.path_coordinates(index).astype(int)
-
-                radii = [dist_transform[y, x] for y, x in coords]
-                true_rad_px = np.median(radii) if len(radii) >= MICRO_SEGMENT_PX else (np.mean(radii) if radii else 0)
-                true_rad_mm = true_rad_px * mm_per_pixel
-                vol_mm3 = np.pi * (true_rad_mm ** 2) * dist_mm
-
-                is_primary = index in primary_edges
-                if is_primary:
-                    metrics["primary_root_len_mm"] += dist_mm
-                    metrics["primary_root_vol_mm3"] += vol_mm3
+            # === РАДИУСЫ ВЕТВЕЙ: все пиксели путей одним массивом ===
+            # skeleton_obj.paths — CSR (ветвь → пиксели скелета в порядке обхода)
+            indptr = skeleton_obj.paths.indptr
+            path_starts = indptr[valid]
+            path_lengths_px = indptr[valid + 1] - path_starts
+            path_offsets = np.zeros(len(valid) + 1, dtype=np.int64)
+            path_offsets[1:] = np.cumsum(path_lengths_px)
+            flat = np.repeat(path_starts - path_offsets[:-1], path_lengths_px) + np.arange(path_offsets[-1])
+            path_coords = skeleton_obj.coordinates[skeleton_obj.paths.indices[flat]].astype(int)
+            radii = dist_transform[path_coords[:, 0], path_coords[:, 1]]
+
+            # Медиана по каждой ветви: сортировка радиусов внутри групп + середина группы
+            group = np.repeat(np.arange(len(valid)), path_lengths_px)
+            sorted_radii = radii[np.lexsort((radii, group))]
+            has_pixels = path_lengths_px > 0
+            mid_hi = path_offsets[:-1] + path_lengths_px // 2
+            mid_lo = path_offsets[:-1] + (path_lengths_px - 1) // 2
+            medians = np.zeros(len(valid), dtype=np.float32)
+            medians[has_pixels] = (sorted_radii[mid_lo[has_pixels]] + sorted_radii[mid_hi[has_pixels]]) / np.float32(2)
+            sums = np.zeros(len(valid), dtype=np.float32)
+            sums[has_pixels] = np.add.reduceat(radii, path_offsets[:-1][has_pixels])
+            means = np.zeros(len(valid), dtype=np.float32)
+            means[has_pixels] = sums[has_pixels] / path_lengths_px[has_pixels]
+
+            true_rad_px = np.where(path_lengths_px >= MICRO_SEGMENT_PX, medians, means).astype(np.float64)
+            true_rad_mm = true_rad_px * mm_per_pixel
+            dist_mm = dist_mm_all[valid]
+            vol_mm3 = np.pi * (true_rad_mm ** 2) * dist_mm
+            surface_mm2 = 2.0 * np.pi * true_rad_mm * dist_mm  # цилиндрическая модель, WinRHIZO
+            is_primary = np.array([idx in primary_edges for idx in valid_branch_indices.tolist()], dtype=bool)
+
+            for k, index in enumerate(valid_branch_indices):
+                if is_primary[k]:
+                    metrics["primary_root_len_mm"] += dist_mm[k]
+                    metrics["primary_root_vol_mm3"] += vol_mm3[k]
                 else:
-                    metrics["lateral_root_len_mm"] += dist_mm
-                    metrics["lateral_root_vol_mm3"] += vol_mm3
-
-                metrics["total_root_len_mm"] += dist_mm
-                metrics["total_root_vol_mm3"] += vol_mm3
+                    metrics["lateral_root_len_mm"] += dist_mm[k]
+                    metrics["lateral_root_vol_mm3"] += vol_mm3[k]
 
-                # Поверхность сегмента: 2π·r·L (цилиндрическая модель, WinRHIZO)
-                surface_mm2 = 2.0 * np.pi * true_rad_mm * dist_mm
-                metrics["root_surface_area_mm2"] += surface_mm2
+                metrics["total_root_len_mm"] += dist_mm[k]
+                metrics["total_root_vol_mm3"] += vol_mm3[k]
+                metrics["root_surface_area_mm2"] += surface_mm2[k]
 
                 segment_data = {
                     "id": int(index),
-                    "type": "Стержневой (Первичный)" if is_primary else "Боковой (Латеральный)",
-                    "length_mm": round(dist_mm, 2),
-                    "thickness_mm": round(true_rad_mm * 2, 3),
-                    "volume_mm3": round(vol_mm3, 2),
-                    "path": [[int(x), int(y)] for y, x in coords]
+                    "type": "Стержневой (Первичный)" if is_primary[k] else "Боковой (Латеральный)",
+                    "length_mm": round(dist_mm[k], 2),
+                    "thickness_mm": round(true_rad_mm[k] * 2, 3),
+                    "volume_mm3": round(vol_mm3[k], 2),
+                    "path": path_coords[path_offsets[k]:path_offsets[k + 1], ::-1].tolist()
                 }
                 metrics["segments"].append(segment_data)
 
             # === RSA-МЕТРИКИ (Root System Architecture) ===
             # Кончики корней: только валидные endpoint-ветви (не отфильтрованные как шум)
-            b_type_col = 'branch-type' if 'branch-type' in branch_data.columns else 'branch_type'
-            metrics["root_tip_count"] = sum(
-                1 for idx in valid_branch_indices
-                if branch_data.loc[idx, b_type_col] == 1
-            )
+            metrics["root_tip_count"] = int(np.count_nonzero(b_type[valid] == 1))
 
             # Узлы ветвления (fork): вершины графа со степенью >= 3
             metrics["root_fork_count"] = sum(1 for n in G.nodes() if G.degree(n) >= 3)
 
             # Число боковых корней (латеральных сегментов)
-            lateral_count = sum(1 for idx in valid_branch_indices if idx not in primary_edges)
+            lateral_count = int(np.count_nonzero(~is_primary))
             metrics["lateral_root_count"] = lateral_count
 
             # Интенсивность ветвления (Fitter & Stickland, 1991)
@@ -557,58 +1905,93 @@ def analyze_biomass(yolo_model, img, conf, iou, imgsz, draw_annotation=False, de
             metrics["total_root_len_mm"] / metrics["total_root_vol_mm3"], 4
         ))
 
-    if draw_annotation:
-        canvas = img.copy()
-
-        if bake_overlay:
-            # --- РИСУЕМ МАСКИ ПРЯМО НА ФОТО (baked overlay) ---
-            def hex_to_bgr(hex_color):
-                hex_color = hex_color.lstrip('#')
-                r, g, b = int(hex_color[0:2], 16), int(hex_color[2:4], 16), int(hex_color[4:6], 16)
-                return (b, g, r)
-
-            overlay = canvas.copy()
-            alpha = 0.35  # прозрачность заливки
-
-            # Листья
-            if np.any(leaf_mask):
-                bgr = hex_to_bgr(color_leaf)
-                overlay[leaf_mask > 0] = bgr
-                contours_l, _ = cv2.findContours(leaf_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                cv2.drawContours(canvas, contours_l, -1, bgr, 2)
-
-            # Стебли
-            if np.any(stem_mask):
-                bgr = hex_to_bgr(color_stem)
-                overlay[stem_mask > 0] = bgr
-                contours_s, _ = cv2.findContours(stem_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                cv2.drawContours(canvas, contours_s, -1, bgr, 2)
-
-            # Корни
-            if np.any(root_mask):
-                bgr = hex_to_bgr(color_root)
-                overlay[root_mask > 0] = bgr
-                contours_r, _ = cv2.findContours(root_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                cv2.drawContours(canvas, contours_r, -1, bgr, 2)
-
-            cv2.addWeighted(overlay, alpha, canvas, 1 - alpha, 0, canvas)
+    if masks_out is not None:
+        masks_out.update(leaf=leaf_mask, root=root_mask, stem=stem_mask)
 
+    if draw_annotation:
+        canvas = render_overlay(img, leaf_mask, root_mask, stem_mask, bake_overlay,
+                                color_leaf, color_root, color_stem)
         return metrics, canvas
 
     return metrics, None
 
 
+def hex_to_bgr(hex_color):
+    hex_color = hex_color.lstrip('#')
+    r, g, b = int(hex_color[0:2], 16), int(hex_color[2:4], 16), int(hex_color[4:6], 16)
+    return (b, g, r)
+
+
+def render_overlay(img, leaf_mask, root_mask, stem_mask, bake_overlay=False,
+                   color_leaf='#16A34A', color_root='#9333EA', color_stem='#2563EB'):
+    """Рисует финальные маски на фото. Не зависит от YOLO — используется и в /annotate,
+    и в /render (перекраска по сохранённым маскам без повторного инференса)."""
+    canvas = img.copy()
+
+    if bake_overlay:
+        # --- РИСУЕМ МАСКИ ПРЯМО НА ФОТО (baked overlay) ---
+        overlay = canvas.copy()
+        alpha = 0.35  # прозрачность заливки
+
+        # Листья
+        if np.any(leaf_mask):
+            bgr = hex_to_bgr(color_leaf)
+            overlay[leaf_mask > 0] = bgr
+            contours_l, _ = cv2.findContours(leaf_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            cv2.drawContours(canvas, contours_l, -1, bgr, 2)
+
+        # Стебли
+        if np.any(stem_mask):
+            bgr = hex_to_bgr(color_stem)
+            overlay[stem_mask > 0] = bgr
+            contours_s, _ = cv2.findContours(stem_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            cv2.drawContours(canvas, contours_s, -1, bgr, 2)
+
+        # Корни
+        if np.any(root_mask):
+            bgr = hex_to_bgr(color_root)
+            overlay[root_mask > 0] = bgr
+            contours_r, _ = cv2.findContours(root_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            cv2.drawContours(canvas, contours_r, -1, bgr, 2)
+
+        cv2.addWeighted(overlay, alpha, canvas, 1 - alpha, 0, canvas)
+
+    return canvas
+
+
+def encode_masks(leaf_mask, root_mask, stem_mask) -> bytes:
+    """Упаковывает три бинарные маски в один PNG (битовые плоскости: 1=leaf, 2=root, 4=stem)."""
+    packed = (leaf_mask > 0).astype(np.uint8) | ((root_mask > 0).astype(np.uint8) << 1) \
+        | ((stem_mask > 0).astype(np.uint8) << 2)
+    _, buffer = cv2.imencode('.png', packed, [cv2.IMWRITE_PNG_COMPRESSION, 3])
+    return buffer.tobytes()
+
+
+def decode_masks(blob: bytes):
+    packed = cv2.imdecode(np.frombuffer(blob, np.uint8), cv2.IMREAD_UNCHANGED)
+    return packed & 1, (packed >> 1) & 1, (packed >> 2) & 1
+
+
 def _parse_calibration(camera_matrix_json: Optional[str], dist_coeffs_json: Optional[str],
-                       user_mm_per_pixel: Optional[float], user_cm2_per_pixel: Optional[float]):
-    """Парсит пользовательские параметры калибровки.
-    Возвращает (cam_mtx, dist_coeffs, mm_per_pixel, cm2_per_pixel).
+                       user_mm_per_pixel: Optional[float], user_cm2_per_pixel: Optional[float],
+                       calibration_id: Optional[str] = None):
+    """Парсит пользовательские параметры калибровки (профиль по calibration_id или JSON-матрицы).
+    Возвращает (cam_mtx, dist_coeffs, mm_per_pixel, cm2_per_pixel, calibration_key).
     cam_mtx и dist_coeffs = None, если пользователь не калибровал камеру
-    (undistort нельзя применять с чужими параметрами — это исказит фото)."""
+    (undistort нельзя применять с чужими параметрами — это исказит фото).
+    calibration_key — id калибровки для ключей кэша (None, если undistort не применяется)."""
     cam_mtx = None
     d_coeffs = None
     mpp = user_mm_per_pixel
     cpp = user_cm2_per_pixel
 
+    if calibration_id:
+        profile = calibration_profiles.get(calibration_id)
+        if profile is None:
+            raise HTTPException(status_code=409, detail="Профиль калибровки не найден, зарегистрируйте его заново")
+        cam_mtx, d_coeffs = profile
+        return cam_mtx, d_coeffs, mpp, cpp, calibration_id
+
     if camera_matrix_json:
         try:
             cam_mtx = np.array(json.loads(camera_matrix_json))
@@ -620,119 +2003,344 @@ def _parse_calibration(camera_matrix_json: Optional[str], dist_coeffs_json: Opti
         except Exception:
             d_coeffs = None
 
-    return cam_mtx, d_coeffs, mpp, cpp
+    calibration_key = None
+    if cam_mtx is not None and d_coeffs is not None:
+        calibration_key = undistort_maps.profile_key(cam_mtx, d_coeffs)
+    return cam_mtx, d_coeffs, mpp, cpp, calibration_key
+
+
+def _decode_image(contents: bytes, cam_mtx=None, d_coeffs=None):
+    nparr = np.frombuffer(contents, np.uint8)
+    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if img is not None and cam_mtx is not None and d_coeffs is not None:
+        img = undistort_maps.undistort(img, cam_mtx, d_coeffs)
+    return img
+
+
+def _tile_size(tiled):
+    """Form-поле tiled → tile_size для analyze_biomass (None — решает TILE_AUTO_MIN_SIDE)."""
+    if tiled is None:
+        return None
+    return TILE_SIZE if tiled else 0
+
+
+def _run_predict(img, conf, iou, imgsz, deep_scan, mpp, cpp,
+                 model_name=None, tta_batch_size=None, tiled=None):
+    with registry.use(model_name) as yolo_model, PeakRssMeter() as meter:
+        if micro_batcher is not None:
+            yolo_model = BatchedModel(micro_batcher, registry.canonical_name(model_name), yolo_model)
+        metrics, _ = analyze_biomass(yolo_model, img, conf, iou, imgsz, False, deep_scan, mpp, cpp,
+                                     tta_batch_size=tta_batch_size, tile_size=_tile_size(tiled))
+    metrics["memory"] = meter.report()
+    return metrics, None
+
+
+def _analysis_key(contents, endpoint, model_name, conf, iou, imgsz, deep_scan,
+                  calibration_key, mpp, cpp, **extra):
+    return ResultCache.make_key(
+        contents, endpoint=endpoint, model_name=registry.canonical_name(model_name),
+        model_version=registry.version(model_name), conf=conf, iou=iou, imgsz=imgsz, deep_scan=deep_scan,
+        calibration=calibration_key, mm_per_pixel=mpp, cm2_per_pixel=cpp,
+        **extra)
+
+
+def _run_annotate(img, conf, iou, imgsz, deep_scan, mpp, cpp,
+                  model_name=None, tta_batch_size=None, bake_overlay=False,
+                  color_leaf='#16A34A', color_root='#9333EA', color_stem='#2563EB', mask_key=None, tiled=None):
+    """Только инференс и отрисовка; JPEG, base64 и PNG масок — в _encode_annotate на CPU-потоке."""
+    masks = {}
+    with registry.use(model_name) as yolo_model, PeakRssMeter() as meter:
+        if micro_batcher is not None:
+            yolo_model = BatchedModel(micro_batcher, registry.canonical_name(model_name), yolo_model)
+        metrics, annotated_frame = analyze_biomass(
+            yolo_model, img, conf, iou, imgsz, True, deep_scan, mpp, cpp,
+            bake_overlay=bake_overlay, color_leaf=color_leaf, color_root=color_root, color_stem=color_stem,
+            tta_batch_size=tta_batch_size, masks_out=masks, tile_size=_tile_size(tiled)
+        )
+
+    if annotated_frame is None: return {"annotated_image_base64": None}, None
+
+    # Возвращаем ВСЕ метрики (включая RSA, фрактальную размерность и т.д.)
+    # чтобы DeepScan-результаты не терялись
+    result = {k: v for k, v in metrics.items() if k != 'annotated_image_base64'}
+    result["is_deep_scan"] = deep_scan
+    result["is_baked"] = bake_overlay
+    result["mask_id"] = mask_key
+    result["memory"] = meter.report()
+    return result, (annotated_frame, masks, mask_key)
+
+
+def _encode_annotate(result, payload):
+    """JPEG остаётся байтами (annotated_image_jpeg): base64 нужен только json-ответу и кэшу."""
+    if payload is None:
+        return result
+    annotated_frame, masks, mask_key = payload
+    if mask_key:
+        mask_store.put_blob(mask_key, encode_masks(masks["leaf"], masks["root"], masks["stem"]))
+
+    _, buffer = cv2.imencode('.jpg', annotated_frame)
+    result["annotated_image_jpeg"] = buffer.tobytes()
+    return result
+
+
+def _with_base64(result: dict, jpeg: bytes) -> dict:
+    return {**result, "annotated_image_base64": base64.b64encode(jpeg).decode('utf-8')}
+
+
+# Измерения конкретного прогона: в кэш не пишутся, иначе попадание отдаёт чужие цифры
+RUN_STATS_KEYS = ("memory", "timings_ms")
+
+
+def _without_run_stats(result: dict) -> dict:
+    return {k: v for k, v in result.items() if k not in RUN_STATS_KEYS}
+
+
+def _cache_annotated(cache_key: str, result: dict, jpeg: bytes) -> dict:
+    """В кэше изображение лежит base64 внутри JSON — как в ответе json-режима."""
+    result = _with_base64(result, jpeg)
+    result_cache.put(cache_key, _without_run_stats(result))
+    return result
+
+
+def _multipart_response(result: dict, jpeg: bytes, background=None) -> Response:
+    """response_format=multipart: multipart/mixed из двух частей — JSON метрик и JPEG без base64.
+    У каждой части есть Content-Length, клиент читает их потоково, не разбирая тело целиком."""
+    boundary = uuid.uuid4().hex
+    meta = json.dumps(result, default=_json_default).encode("utf-8")
+    body = b"".join([
+        f"--{boundary}\r\nContent-Type: application/json\r\nContent-Length: {len(meta)}\r\n\r\n".encode(),
+        meta,
+        f"\r\n--{boundary}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n".encode(),
+        jpeg,
+        f"\r\n--{boundary}--\r\n".encode(),
+    ])
+    return Response(content=body, media_type=f"multipart/mixed; boundary={boundary}", background=background)
+
+
+def _run_render(contents, mask_key, cam_mtx, d_coeffs, bake_overlay,
+                color_leaf='#16A34A', color_root='#9333EA', color_stem='#2563EB', response_format="json"):
+    blob = mask_store.get_blob(mask_key)
+    if blob is None:
+        raise HTTPException(status_code=404, detail="Маски для этих параметров не найдены, нужен /annotate")
+
+    img = _decode_image(contents, cam_mtx, d_coeffs)
+    leaf_mask, root_mask, stem_mask = decode_masks(blob)
+    canvas = render_overlay(img, leaf_mask, root_mask, stem_mask, bake_overlay,
+                            color_leaf, color_root, color_stem)
+    _, buffer = cv2.imencode('.jpg', canvas)
+    result = {"is_baked": bake_overlay, "mask_id": mask_key}
+    if response_format == "multipart":
+        return _multipart_response(result, buffer.tobytes())
+    return _with_base64(result, buffer.tobytes())
 
 
 @app.get("/models")
 async def list_models():
-    return {"models": registry.list_models()}
+    return {"models": registry.list_models(), "registry": registry.stats(), "inference": inference_pool.stats(),
+            "pipeline": pipeline.stats()}
+
+
+@app.post("/models/rescan")
+async def rescan_models():
+    """Пересканировать MODELS_DIR сейчас, не дожидаясь фонового опроса."""
+    result = await asyncio.to_thread(registry.scan)
+    return {**result, "models": registry.list_models()}
+
+
+@app.get("/health")
+async def health():
+    return {
+        "status": "ok",
+        **inference_pool.stats(),
+        "pipeline": pipeline.stats(),
+        "micro_batching": micro_batcher.stats() if micro_batcher is not None else None,
+        "result_cache": result_cache.stats(),
+        "mask_store": mask_store.stats(),
+        "undistort_maps": undistort_maps.stats(),
+        "calibration_profiles": calibration_profiles.stats(),
+    }
 
 
 @app.post("/predict")
 async def predict_plant(file: UploadFile = File(...),
                         conf: float = Form(0.1), iou: float = Form(0.6), imgsz: int = Form(2048),
                         deep_scan: bool = Form(False),
+                        tta_batch_size: Optional[int] = Form(None),
+                        tiled: Optional[bool] = Form(None),
                         model_name: Optional[str] = Form(None),
+                        calibration_id: Optional[str] = Form(None),
                         camera_matrix_json: Optional[str] = Form(None),
                         dist_coeffs_json: Optional[str] = Form(None),
                         user_mm_per_pixel: Optional[float] = Form(None),
-                        user_cm2_per_pixel: Optional[float] = Form(None)):
-    cam_mtx, d_coeffs, mpp, cpp = _parse_calibration(
-        camera_matrix_json, dist_coeffs_json, user_mm_per_pixel, user_cm2_per_pixel)
+                        user_cm2_per_pixel: Optional[float] = Form(None),
+                        use_cache: bool = Form(True),
+                        geometry_format: str = Form("json"),
+                        simplify_px: float = Form(0.0)):
+    cam_mtx, d_coeffs, mpp, cpp, calib_key = _parse_calibration(
+        camera_matrix_json, dist_coeffs_json, user_mm_per_pixel, user_cm2_per_pixel, calibration_id)
 
-    yolo_model = registry.get_model(model_name)
     contents = await file.read()
-    nparr = np.frombuffer(contents, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if cam_mtx is not None and d_coeffs is not None:
-        img = cv2.undistort(img, cam_mtx, d_coeffs, None, cam_mtx)
-    metrics, _ = analyze_biomass(yolo_model, img, conf, iou, imgsz, False, deep_scan, mpp, cpp)
-    return metrics
+    cache_key = _analysis_key(contents, "predict", model_name, conf, iou, imgsz, deep_scan,
+                              calib_key, mpp, cpp, tiled=tiled)
+    if use_cache:
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            cached = _without_run_stats(cached)  # записи, сохранённые до исключения этих полей
+            cached["cache_hit"] = True
+            return format_geometry(cached, geometry_format, simplify_px)
+
+    metrics = await pipeline.run(
+        contents, cam_mtx, d_coeffs, _run_predict, conf, iou, imgsz, deep_scan, mpp, cpp,
+        model_name=model_name, tta_batch_size=tta_batch_size, tiled=tiled
+    )
+    await asyncio.to_thread(result_cache.put, cache_key, _without_run_stats(metrics))
+    metrics["cache_hit"] = False
+    return format_geometry(metrics, geometry_format, simplify_px)
 
 
 @app.post("/annotate")
 async def annotate_plant(file: UploadFile = File(...),
                          conf: float = Form(0.1), iou: float = Form(0.6), imgsz: int = Form(2048),
                          deep_scan: bool = Form(False),
+                         tta_batch_size: Optional[int] = Form(None),
+                         tiled: Optional[bool] = Form(None),
                          bake_overlay: bool = Form(False),
                          model_name: Optional[str] = Form(None),
                          color_leaf: str = Form('#16A34A'),
                          color_root: str = Form('#9333EA'),
                          color_stem: str = Form('#2563EB'),
+                         calibration_id: Optional[str] = Form(None),
                          camera_matrix_json: Optional[str] = Form(None),
                          dist_coeffs_json: Optional[str] = Form(None),
                          user_mm_per_pixel: Optional[float] = Form(None),
-                         user_cm2_per_pixel: Optional[float] = Form(None)):
-    cam_mtx, d_coeffs, mpp, cpp = _parse_calibration(
-        camera_matrix_json, dist_coeffs_json, user_mm_per_pixel, user_cm2_per_pixel)
+                         user_cm2_per_pixel: Optional[float] = Form(None),
+                         use_cache: bool = Form(True),
+                         geometry_format: str = Form("json"),
+                         simplify_px: float = Form(0.0),
+                         response_format: str = Form("json")):
+    """response_format=multipart — метрики и JPEG отдельными частями multipart/mixed (без base64)."""
+    cam_mtx, d_coeffs, mpp, cpp, calib_key = _parse_calibration(
+        camera_matrix_json, dist_coeffs_json, user_mm_per_pixel, user_cm2_per_pixel, calibration_id)
 
-    yolo_model = registry.get_model(model_name)
     contents = await file.read()
-    nparr = np.frombuffer(contents, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if cam_mtx is not None and d_coeffs is not None:
-        img = cv2.undistort(img, cam_mtx, d_coeffs, None, cam_mtx)
-
-    metrics, annotated_frame = analyze_biomass(
-        yolo_model, img, conf, iou, imgsz, True, deep_scan, mpp, cpp,
-        bake_overlay=bake_overlay, color_leaf=color_leaf, color_root=color_root, color_stem=color_stem
+    cache_key = _analysis_key(contents, "annotate", model_name, conf, iou, imgsz, deep_scan,
+                              calib_key, mpp, cpp, tiled=tiled, bake_overlay=bake_overlay,
+                              color_leaf=color_leaf, color_root=color_root, color_stem=color_stem)
+    mask_key = _analysis_key(contents, "masks", model_name, conf, iou, imgsz, deep_scan,
+                             calib_key, mpp, cpp, tiled=tiled)
+    if use_cache:
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            cached = _without_run_stats(cached)  # записи, сохранённые до исключения этих полей
+            cached["cache_hit"] = True
+            if response_format == "multipart":
+                jpeg = base64.b64decode(cached.pop("annotated_image_base64"))
+                return _multipart_response(format_geometry(cached, geometry_format, simplify_px), jpeg)
+            return format_geometry(cached, geometry_format, simplify_px)
+
+    result = await pipeline.run(
+        contents, cam_mtx, d_coeffs, _run_annotate, conf, iou, imgsz, deep_scan, mpp, cpp,
+        encode=_encode_annotate,
+        model_name=model_name, tta_batch_size=tta_batch_size, bake_overlay=bake_overlay,
+        color_leaf=color_leaf, color_root=color_root, color_stem=color_stem, mask_key=mask_key,
+        tiled=tiled
     )
+    jpeg = result.pop("annotated_image_jpeg", None)
+    if jpeg is None:
+        result["cache_hit"] = False
+        return format_geometry(result, geometry_format, simplify_px)
+
+    if response_format == "multipart":
+        # Кэш (с base64) пишется уже после отправки ответа
+        body = format_geometry({**result, "cache_hit": False}, geometry_format, simplify_px)
+        return _multipart_response(body, jpeg, BackgroundTask(_cache_annotated, cache_key, result, jpeg))
+
+    result = await asyncio.to_thread(_cache_annotated, cache_key, result, jpeg)
+    result["cache_hit"] = False
+    return format_geometry(result, geometry_format, simplify_px)
+
+
+@app.post("/render")
+async def render_plant(file: UploadFile = File(...),
+                       conf: float = Form(0.1), iou: float = Form(0.6), imgsz: int = Form(2048),
+                       deep_scan: bool = Form(False),
+                       tiled: Optional[bool] = Form(None),
+                       bake_overlay: bool = Form(False),
+                       model_name: Optional[str] = Form(None),
+                       color_leaf: str = Form('#16A34A'),
+                       color_root: str = Form('#9333EA'),
+                       color_stem: str = Form('#2563EB'),
+                       calibration_id: Optional[str] = Form(None),
+                       camera_matrix_json: Optional[str] = Form(None),
+                       dist_coeffs_json: Optional[str] = Form(None),
+                       user_mm_per_pixel: Optional[float] = Form(None),
+                       user_cm2_per_pixel: Optional[float] = Form(None),
+                       response_format: str = Form("json")):
+    """Только перерисовка overlay (цвета / bake_overlay) по маскам, сохранённым /annotate
+    с теми же параметрами анализа. YOLO не запускается; если масок нет — 404.
+    response_format=multipart — как в /annotate."""
+    cam_mtx, d_coeffs, mpp, cpp, calib_key = _parse_calibration(
+        camera_matrix_json, dist_coeffs_json, user_mm_per_pixel, user_cm2_per_pixel, calibration_id)
 
-    if annotated_frame is None: return {"annotated_image_base64": None}
-
-    _, buffer = cv2.imencode('.jpg', annotated_frame)
-
-    # Возвращаем ВСЕ метрики (включая RSA, фрактальную размерность и т.д.)
-    # чтобы DeepScan-результаты не терялись
-    result = {k: v for k, v in metrics.items() if k != 'annotated_image_base64'}
-    result["annotated_image_base64"] = base64.b64encode(buffer).decode('utf-8')
-    result["is_deep_scan"] = deep_scan
-    result["is_baked"] = bake_overlay
-    return result
+    contents = await file.read()
+    mask_key = _analysis_key(contents, "masks", model_name, conf, iou, imgsz, deep_scan,
+                             calib_key, mpp, cpp, tiled=tiled)
+    return await asyncio.to_thread(
+        _run_render, contents, mask_key, cam_mtx, d_coeffs, bake_overlay, color_leaf, color_root, color_stem,
+        response_format)
+
+
+# Калибровка: поиск доски на фото идёт параллельно (CALIB_WORKERS потоков), сначала на копии,
+# уменьшенной до CALIB_DETECT_MAX_SIDE по большей стороне; уточнение cornerSubPix — в полном разрешении.
+CALIB_WORKERS = int(os.getenv("CALIB_WORKERS", 4))
+CALIB_DETECT_MAX_SIDE = int(os.getenv("CALIB_DETECT_MAX_SIDE", 1280))
+
+
+def _detect_chessboard(contents: bytes, rows: int, cols: int, criteria):
+    """→ (img_size, уточнённые углы | None); (None, None), если фото не читается."""
+    gray = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None, None
+    img_size = gray.shape[::-1]
+
+    scale = CALIB_DETECT_MAX_SIDE / max(img_size) if CALIB_DETECT_MAX_SIDE > 0 else 1.0
+    found, corners = False, None
+    if scale < 1.0:
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        found, corners = cv2.findChessboardCorners(small, (cols, rows), None)
+        if found:
+            corners = corners / scale
+    if not found:
+        # Мелкая доска может потеряться при уменьшении — повторяем в полном разрешении
+        found, corners = cv2.findChessboardCorners(gray, (cols, rows), None)
+    if not found:
+        return img_size, None
 
+    return img_size, cv2.cornerSubPix(gray, corners.astype(np.float32), (11, 11), (-1, -1), criteria)
 
-@app.post("/calibrate")
-async def calibrate_camera(files: List[UploadFile] = File(...),
-                           rows: int = Form(6),
-                           cols: int = Form(9),
-                           square_size_mm: float = Form(25.0)):
-    """Калибровка камеры по шахматной доске (OpenCV).
-    Принимает несколько фотографий доски, возвращает camera_matrix, dist_coeffs, mm_per_pixel."""
 
+def _run_calibration(images_bytes: List[bytes], rows: int, cols: int, square_size_mm: float):
     objp = np.zeros((rows * cols, 3), np.float32)
     objp[:, :2] = np.mgrid[0:cols, 0:rows].T.reshape(-1, 2) * square_size_mm
 
-    objpoints = []
-    imgpoints = []
-    img_size = None
-    images_used = 0
-
     criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
 
-    for f in files:
-        contents = await f.read()
-        nparr = np.frombuffer(contents, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        if img is None:
-            continue
+    with ThreadPoolExecutor(max_workers=max(1, CALIB_WORKERS), thread_name_prefix="calib") as executor:
+        detections = list(executor.map(lambda contents: _detect_chessboard(contents, rows, cols, criteria),
+                                       images_bytes))
 
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        if img_size is None:
-            img_size = gray.shape[::-1]
-
-        found, corners = cv2.findChessboardCorners(gray, (cols, rows), None)
-        if found:
-            corners_refined = cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
-            objpoints.append(objp)
-            imgpoints.append(corners_refined)
-            images_used += 1
+    sizes = [size for size, _ in detections if size is not None]
+    img_size = sizes[0] if sizes else None
+    imgpoints = [corners for _, corners in detections if corners is not None]
+    objpoints = [objp] * len(imgpoints)
+    images_used = len(imgpoints)
 
     if images_used < 3:
         return {
             "success": False,
-            "error": f"Найдена шахматная доска только на {images_used} из {len(files)} фото. Нужно минимум 3.",
+            "error": f"Найдена шахматная доска только на {images_used} из {len(images_bytes)} фото. Нужно минимум 3.",
             "images_used": images_used,
-            "images_total": len(files)
+            "images_total": len(images_bytes)
         }
 
     ret, camera_matrix, dist_coeffs, rvecs, tvecs = cv2.calibrateCamera(
@@ -740,21 +2348,11 @@ async def calibrate_camera(files: List[UploadFile] = File(...),
     )
 
     # Расчёт mm_per_pixel: средняя дистанция между соседними углами в пикселях
-    pixel_dists = []
-    for corners in imgpoints:
-        corners_flat = corners.reshape(-1, 2)
-        for r in range(rows):
-            for c in range(cols - 1):
-                idx1 = r * cols + c
-                idx2 = r * cols + c + 1
-                d = np.linalg.norm(corners_flat[idx1] - corners_flat[idx2])
-                pixel_dists.append(d)
-        for r in range(rows - 1):
-            for c in range(cols):
-                idx1 = r * cols + c
-                idx2 = (r + 1) * cols + c
-                d = np.linalg.norm(corners_flat[idx1] - corners_flat[idx2])
-                pixel_dists.append(d)
+    grid = np.stack(imgpoints).reshape(len(imgpoints), rows, cols, 2)
+    pixel_dists = np.concatenate([
+        np.linalg.norm(np.diff(grid, axis=2), axis=-1).ravel(),  # соседи в строке
+        np.linalg.norm(np.diff(grid, axis=1), axis=-1).ravel(),  # соседи в столбце
+    ])
 
     mean_pixel_dist = np.mean(pixel_dists)
     mm_pp = square_size_mm / mean_pixel_dist
@@ -768,5 +2366,36 @@ async def calibrate_camera(files: List[UploadFile] = File(...),
         "cm2_per_pixel": round(float(cm2_pp), 8),
         "reprojection_error": round(float(ret), 4),
         "images_used": images_used,
-        "images_total": len(files)
+        "images_total": len(images_bytes),
+        "image_size": list(img_size),
     }
+
+
+@app.post("/calibrate")
+async def calibrate_camera(files: List[UploadFile] = File(...),
+                           rows: int = Form(6),
+                           cols: int = Form(9),
+                           square_size_mm: float = Form(25.0)):
+    """Калибровка камеры по шахматной доске (OpenCV).
+    Принимает несколько фотографий доски, возвращает camera_matrix, dist_coeffs, mm_per_pixel."""
+    images_bytes = [await f.read() for f in files]
+    result = await inference_pool.run(_run_calibration, images_bytes, rows, cols, square_size_mm)
+    if result["success"]:
+        result["calibration_id"] = await asyncio.to_thread(
+            calibration_profiles.register, result["camera_matrix"], result["dist_coeffs"], result["image_size"])
+    return result
+
+
+@app.post("/calibration/profiles")
+async def register_calibration_profile(camera_matrix_json: str = Form(...),
+                                       dist_coeffs_json: str = Form(...),
+                                       image_size_json: Optional[str] = Form(None)):
+    """Регистрация уже имеющейся калибровки (сделанной до появления профилей) → calibration_id."""
+    try:
+        camera_matrix = json.loads(camera_matrix_json)
+        dist_coeffs = json.loads(dist_coeffs_json)
+        image_size = json.loads(image_size_json) if image_size_json else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный JSON калибровки")
+    profile_id = await asyncio.to_thread(calibration_profiles.register, camera_matrix, dist_coeffs, image_size)
+    return {"calibration_id": profile_id}
@@ -0,0 +1,44 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeYOLO:
+    """Подмена ultralytics.YOLO: без чтения весов, модель ~1 МБ для учёта памяти реестром."""
+
+    def __init__(self, path, task=None):
+        import torch
+        self.path = path
+        self.model = torch.nn.Linear(1, 256 * 1024, bias=False)
+
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    """Модуль main.py, импортированный с временной папкой моделей, без фоновых потоков и диска."""
+    pytest.importorskip("fastapi")
+    ultralytics = pytest.importorskip("ultralytics")
+    models_dir = tmp_path_factory.mktemp("models")
+    (models_dir / "default.pt").write_bytes(b"\0" * 1024)
+    env = {
+        "MODELS_DIR": str(models_dir),
+        "DEFAULT_MODEL": "default.pt",
+        "PINNED_MODELS": "default.pt",
+        "MODEL_INDEX_FILE": "",
+        "MODELS_WATCH_INTERVAL_S": "0",
+        "MODEL_PREFETCH_INTERVAL_S": "0",
+        "RESULT_CACHE_DIR": "",
+        "MASK_STORE_DIR": "",
+        "CALIB_PROFILES_FILE": str(tmp_path_factory.mktemp("calib") / "calib_profiles.json"),
+    }
+    with pytest.MonkeyPatch.context() as mp:
+        for key, value in env.items():
+            mp.setenv(key, value)
+        mp.setattr(ultralytics, "YOLO", FakeYOLO)
+        mp.syspath_prepend(SERVICE_DIR)
+        sys.modules.pop("main", None)
+        module = importlib.import_module("main")
+    return module
@@ -0,0 +1,77 @@
+import cv2
+import numpy as np
+import pytest
+
+
+def box_counting_reference(binary_img):
+    """Исходная реализация с циклами по боксам — эталон для векторизованной версии."""
+    pixels = np.argwhere(binary_img > 0)
+    if len(pixels) < 10:
+        return 0.0
+    min_r, min_c = pixels.min(axis=0)
+    max_r, max_c = pixels.max(axis=0)
+    cropped = binary_img[min_r:max_r + 1, min_c:max_c + 1]
+    sizes = [2, 4, 8, 16, 32, 64, 128]
+    counts = []
+    valid_sizes = []
+    for size in sizes:
+        if size > min(cropped.shape):
+            break
+        count = 0
+        for i in range(0, cropped.shape[0], size):
+            for j in range(0, cropped.shape[1], size):
+                if np.any(cropped[i:i + size, j:j + size]):
+                    count += 1
+        if count > 0:
+            counts.append(count)
+            valid_sizes.append(size)
+    if len(valid_sizes) < 3:
+        return 0.0
+    coeffs = np.polyfit(np.log(valid_sizes), np.log(counts), 1)
+    return float(round(-coeffs[0], 4))
+
+
+def _synthetic_masks():
+    masks = {}
+    masks["empty"] = np.zeros((64, 64), np.uint8)
+    masks["few_pixels"] = np.zeros((64, 64), np.uint8)
+    masks["few_pixels"][10, 10:15] = 1
+    masks["filled"] = np.ones((300, 257), np.uint8)
+    masks["thin_line"] = np.zeros((40, 500), np.uint8)
+    cv2.line(masks["thin_line"], (3, 5), (490, 33), 1, 1)
+    masks["circle"] = np.zeros((333, 333), np.uint8)
+    cv2.circle(masks["circle"], (160, 170), 120, 1, 2)
+    masks["narrow_crop"] = np.zeros((200, 200), np.uint8)
+    masks["narrow_crop"][20:180, 50:55] = 1
+    roots = np.zeros((517, 389), np.uint8)
+    rng = np.random.default_rng(7)
+    for _ in range(12):
+        x, y = 190, 10
+        pts = [(x, y)]
+        for _ in range(30):
+            x = int(np.clip(x + rng.integers(-15, 16), 0, 388))
+            y = int(np.clip(y + rng.integers(0, 20), 0, 516))
+            pts.append((x, y))
+        cv2.polylines(roots, [np.array(pts)], False, 1, int(rng.integers(1, 4)))
+    masks["roots"] = roots
+    masks["roots_255"] = roots * 255
+    masks["roots_bool"] = roots.astype(bool)
+    return masks
+
+
+SYNTHETIC = _synthetic_masks()
+
+
+@pytest.mark.parametrize("name", sorted(SYNTHETIC))
+def test_matches_reference_on_synthetic_masks(main, name):
+    mask = SYNTHETIC[name]
+    assert main.box_counting_dimension(mask) == box_counting_reference(mask)
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_matches_reference_on_random_masks(main, seed):
+    rng = np.random.default_rng(seed)
+    h, w = rng.integers(1, 300, size=2)
+    density = rng.choice([0.001, 0.01, 0.1, 0.5])
+    mask = (rng.random((h, w)) < density).astype(np.uint8)
+    assert main.box_counting_dimension(mask) == box_counting_reference(mask)
@@ -0,0 +1,113 @@
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+MODELS = ["a.pt", "b.pt", "c.pt", "d.pt", "e.pt"]
+
+
+@pytest.fixture
+def slow_yolo(main, monkeypatch):
+    """YOLO с медленной загрузкой (~1 МБ весов), учётом параллельных загрузок и падениями e.pt."""
+    import torch
+
+    stats = {"active": Counter(), "peak": Counter(), "loads": Counter()}
+    lock = threading.Lock()
+
+    class SlowYOLO:
+        def __init__(self, path, task=None):
+            name = os.path.basename(path)
+            with lock:
+                stats["active"][name] += 1
+                stats["peak"][name] = max(stats["peak"][name], stats["active"][name])
+                stats["loads"][name] += 1
+            try:
+                time.sleep(random.uniform(0.01, 0.03))
+                if name == "e.pt" and random.random() < 0.3:
+                    raise RuntimeError("load failed")
+                self.name = name
+                self.model = torch.nn.Linear(1, 256 * 1024, bias=False)
+            finally:
+                with lock:
+                    stats["active"][name] -= 1
+
+    monkeypatch.setattr(main, "YOLO", SlowYOLO)
+    return stats
+
+
+@pytest.fixture
+def registry(main, slow_yolo, tmp_path):
+    for name in MODELS:
+        (tmp_path / name).write_bytes(b"\0" * 1024)
+    # До 3 моделей и ~3 МБ: пять моделей постоянно вытесняют друг друга
+    return main.ModelRegistry(str(tmp_path), "a.pt", 3, None, memory_budget_mb=3,
+                              pinned=["a.pt"], prefetch_window=20)
+
+
+def test_concurrent_mixed_models(registry, slow_yolo):
+    random.seed(0)
+    violations = []
+    errors = []
+
+    def request(i):
+        name = random.choice(MODELS)
+        try:
+            with registry.use(name) as model:
+                for _ in range(3):
+                    with registry._lock:
+                        if registry._loaded.get(name) is not model:
+                            violations.append(name)
+                    time.sleep(random.uniform(0, 0.002))
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    stop = threading.Event()
+
+    def prefetch():
+        while not stop.is_set():
+            registry.prefetch_once()
+            time.sleep(0.005)
+
+    prefetcher = threading.Thread(target=prefetch)
+    prefetcher.start()
+    try:
+        with ThreadPoolExecutor(32) as pool:
+            list(pool.map(request, range(1500)))
+    finally:
+        stop.set()
+        prefetcher.join()
+
+    # single-flight: одна модель никогда не грузится в два потока сразу
+    assert max(slow_yolo["peak"].values()) == 1
+    # модель не вытесняется, пока её держит запрос
+    assert violations == []
+    assert set(errors) <= {"load failed"}
+    stats = registry.stats()
+    assert stats["in_use"] == {}
+    assert stats["loading"] == []
+    assert "a.pt" in stats["loaded"]
+    assert len(stats["loaded"]) <= 3
+
+
+def test_waiters_share_failed_load(registry, slow_yolo, monkeypatch):
+    monkeypatch.setattr(random, "random", lambda: 0.0)  # e.pt всегда падает
+    results = []
+
+    def request(i):
+        try:
+            with registry.use("e.pt"):
+                results.append("ok")
+        except RuntimeError as e:
+            results.append(str(e))
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(request, range(8)))
+
+    assert results == ["load failed"] * 8
+    assert slow_yolo["loads"]["e.pt"] < 8
+    assert registry.stats()["in_use"] == {}
+    assert registry.stats()["loading"] == []
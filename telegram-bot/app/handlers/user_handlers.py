@@ -194,7 +194,8 @@ async def handle_photo(message: Message, state: FSMContext):
 
     await wait_msg.delete()
 
-    if status == 201:
+    # 202: анализ поставлен в очередь, результат бэкенд пришлёт отдельным сообщением
+    if status in (201, 202):
         raw_reply = data.get('bot_reply', '✅ Анализ готов!')
         formatted_reply = format_llm_to_html(raw_reply)
 